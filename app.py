@@ -1,22 +1,49 @@
 #!/usr/bin/python3
 """Simple Flask-based Bittrex API wrapper server."""
+import gzip
 import json
 import os
+import queue
+import threading
+from datetime import datetime
 from functools import wraps
 
-from flask import (Flask, flash, redirect, render_template, request, session,
-                   url_for)
+from flask import (Flask, Response, flash, redirect, render_template, request,
+                   session, url_for)
 from flask_pymongo import PyMongo
-from modules.betfair import get_data, get_races
+from modules.betfair import (ensure_basic_indexes, get_data, get_races,
+                             sleeper)
+from modules.compare import record_keys
 from modules.forms import LoginForm
-from modules.racingpost import get_racingpost
+from modules.poller import Poller
+from modules.racingpost import ensure_racingpost_indexes, get_racingpost
 from werkzeug.security import check_password_hash
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
 app.config['UPLOAD_FOLDER'] = 'archive'
 app.config['MONGO_DBNAME'] = 'betfair'
 mongo = PyMongo(app)
+ensure_basic_indexes()
+ensure_racingpost_indexes()
+poller = Poller(lambda: get_data('compare'), sleeper,
+                keys=record_keys, volatile=('Update',))
+
+# Content codings by preference and the smallest body worth compressing
+codings = [('gzip', lambda body: gzip.compress(body, 6))]
+if brotli is not None:
+    codings.insert(0, ('br', lambda body: brotli.compress(body, quality=5)))
+min_compress = 1024
+racingpost_max_age = 60
+
+# Serialized and compressed bytes of the current snapshot, by coding
+encoded = {}
+encoded_lock = threading.Lock()
 
 
 def login_required(f):
@@ -39,6 +66,62 @@ def validate(form):
         return False
 
 
+def pick_coding():
+    """Choose the best content coding the client accepts."""
+    for name, compress in codings:
+        if request.accept_encodings[name]:
+            return name, compress
+    return None, None
+
+
+def json_body(render, key, coding, compress):
+    """Serialize and compress a body, reusing the bytes cached for key."""
+    if key is not None:
+        with encoded_lock:
+            if (key, coding) in encoded:
+                return encoded[(key, coding)]
+            plain = encoded.get((key, None))
+    else:
+        plain = None
+    if plain is None:
+        plain = render()
+        if not isinstance(plain, bytes):
+            plain = plain.encode('utf-8')
+    body = plain
+    if coding is not None:
+        body = compress(plain)
+    if key is not None:
+        with encoded_lock:
+            # Only the current snapshot is worth keeping
+            if any(k != key for k, _ in encoded):
+                encoded.clear()
+            encoded[(key, None)] = plain
+            encoded[(key, coding)] = body
+    return body
+
+
+def json_response(render, key=None, max_age=0):
+    """Build a compressed JSON response of render().
+
+    Responses with the same key share their serialized and compressed
+    bytes, so a snapshot is encoded once per content coding.
+    """
+    coding, compress = pick_coding()
+    plain = json_body(render, key, None, None)
+    body = plain
+    if coding is not None and len(plain) >= min_compress:
+        body = json_body(lambda: plain, key, coding, compress)
+    else:
+        coding = None
+    response = app.response_class(body, mimetype='application/json')
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.private = True
+    response.cache_control.max_age = max(0, int(max_age))
+    return response, coding
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Login procedure function."""
@@ -85,15 +168,89 @@ def racingpost():
 @app.route('/compare.json')
 # @login_required
 def compare_json():
-    """Show the compare json."""
-    return json.dumps(get_data('compare'))
+    """Show the compare json, or its delta with ?since=<version>."""
+    rows, built, version = poller.snapshot()
+    delta = None
+    since = request.args.get('since', type=int)
+    if since is not None:
+        delta = poller.delta(since)
+
+    # Fresh until the poller is due to build the next snapshot
+    max_age = 0
+    if built:
+        max_age = sleeper - (datetime.utcnow() - built).total_seconds()
+    if delta is not None:
+        response, coding = json_response(lambda: json.dumps(delta),
+                                         max_age=max_age)
+    else:
+        response, coding = json_response(
+            lambda: json.dumps(rows),
+            key=None if version is None else ('compare', version),
+            max_age=max_age)
+    if version is not None:
+        response.set_etag('{}-{}'.format(version, coding) if coding
+                          else str(version))
+        response.headers['X-Snapshot-Version'] = str(version)
+    if built:
+        response.last_modified = built
+    return response.make_conditional(request)
+
+
+def sse(event, data):
+    """Format one server-sent event."""
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data))
+
+
+def compare_snapshot():
+    """Get the compare snapshot as a server-sent event."""
+    rows, built, version = poller.snapshot()
+    order = record_keys(rows)
+    return version, sse('snapshot', {'version': version,
+                                     'rows': dict(zip(order, rows)),
+                                     'order': order})
+
+
+@app.route('/compare/stream')
+# @login_required
+def compare_stream():
+    """Push compare snapshots and deltas to the dashboard."""
+    def events():
+        updates = poller.subscribe()
+        try:
+            version, event = compare_snapshot()
+            yield event
+            while True:
+                try:
+                    delta = updates.get(timeout=15)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                if delta is None or delta['version'] <= (version or 0):
+                    continue
+                if delta['since'] != version:
+                    version, event = compare_snapshot()
+                    yield event
+                    continue
+                version = delta['version']
+                yield sse('delta', delta)
+        finally:
+            poller.unsubscribe(updates)
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 @app.route('/racingpost.json')
 # @login_required
 def racingpost_json():
-    """Show the racingpost json."""
-    return get_racingpost()
+    """Show a page of the racingpost json, bootstrap-table server side."""
+    response, _ = json_response(lambda: get_racingpost(
+        limit=request.args.get('limit', 50, type=int),
+        offset=request.args.get('offset', 0, type=int),
+        sort=request.args.get('sort'),
+        order=request.args.get('order', 'asc'),
+        search=request.args.get('search')), max_age=racingpost_max_age)
+    return response
 
 
 if __name__ == '__main__':
@@ -1,44 +1,72 @@
 #!/usr/bin/python3
 """Betfair horse racing backs parser."""
 import argparse
-import itertools
 import json
+import logging
 import os
 import smtplib
+import threading
 from datetime import datetime, timedelta
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
 import requests
-from bson import SON
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
 
-import pandas as pd
 from tabulate import tabulate
 
 client = MongoClient()
 db = client.betfair
 
-data = False
 sleeper = 10
+keep_alive_after = timedelta(hours=1)
+basic_key = ['Update', 'Venue', 'Time', 'Horse']
 ranger = 70.0
+parallelism = 4
+batch_size = 3
+projection = {'priceData': ['EX_BEST_OFFERS'], 'virtualise': True}
+streaming = False
+stream_host = 'stream-api.betfair.com'
+stream_port = 443
+stream_tls = True
+stream_record = None
+stream = None
+catalogue_every = timedelta(hours=1)
+catalogue_retry = timedelta(minutes=1)
+card_check_every = timedelta(minutes=5)
+card_checked = None
+catalogue = {}
+catalogue_lock = threading.Lock()
 woe = False
 regexp = r'-[6-9][0-9]?[0-9]?\.[0-9][0-9]?|-[1-9][0-9][0-9]?\.[0-9][0-9]?'
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--ranger",
                     help="Set ranger value, man.", required=False)
+parser.add_argument("--parallelism",
+                    help="Set concurrent listMarketBook requests.",
+                    required=False)
+
+
+def ensure_basic_indexes():
+    """Create the natural key and schedule indexes for the baseline prices."""
+    keys = [(k, ASCENDING) for k in basic_key]
+    try:
+        db.basic.create_index(keys, unique=True)
+    except OperationFailure:
+        logging.warning('Duplicate baseline prices, index is not unique!')
+        db.basic.create_index(keys)
+    db.basic.create_index([('Update', ASCENDING), ('Time', ASCENDING)])
 
 
 def get_races():
-    """Get current races list."""
+    """Get current races count."""
+    now = datetime.utcnow()
     pipeline =\
         [{"$match":
-          {"Update":
-           {"$gte": '{}'.format(datetime.utcnow().strftime('%Y-%m-%d'))
-            },
-           "Time":
-           {"$gte": '{}'.format(datetime.utcnow().strftime('%H:%M:%S'))}
+          {"Update": {"$gte": datetime(now.year, now.month, now.day)},
+           "Time": {"$gte": now}
            }
           },
          {"$group":
@@ -49,10 +77,10 @@ def get_races():
             }
            }
           },
-         {"$sort": SON([("_id.Time", 1)])
-          }
+         {"$count": "races"}
          ]
-    return len(list(db.basic.aggregate(pipeline)))
+    result = list(db.basic.aggregate(pipeline))
+    return result[0]['races'] if result else 0
 
 
 def send_message(msg, fromaddr, toaddrs):
@@ -106,20 +134,14 @@ def email_alan(df, date):
                     emails_file.write(h + '\n')
 
 
-def pricerator(e):
-    """Generate price."""
-    try:
-        return (item for item
-                in data
-                if item['Horse'] == e[
-                    'Horse']
-                and item['Time'] == e[
-                    'Time']
-                and floatizer(
-                    item['Price'])
-                ).__next__()['Price']
-    except:
-        return False
+def baseline_index(items):
+    """Map (Horse, Time) to the first valid baseline price."""
+    index = {}
+    for item in items:
+        key = (item['Horse'], item['Time'])
+        if key not in index and floatizer(item['Price']):
+            index[key] = float(item['Price'])
+    return index
 
 
 def thirty_five(data):
@@ -161,27 +183,173 @@ def login():
     return response.json()
 
 
+def keep_alive(token):
+    """Extend the session key lifetime."""
+    headers = {'X-Application': xapplication,
+               'X-Authentication': token,
+               'Accept': 'application/json'}
+    response = requests.post(
+        'https://identitysso.betfair.com/api/keepAlive', headers=headers)
+    return response.json()
+
+
+class TokenManager(object):
+    """Thread-safe session key cache shared by every get_data caller."""
+
+    def __init__(self):
+        """Start without a session key."""
+        self.lock = threading.Lock()
+        self.token = None
+        self.refreshed = None
+
+    def get(self):
+        """Return a valid session key, logging in or keeping alive."""
+        with self.lock:
+            if self.token and\
+                    datetime.utcnow() - self.refreshed >= keep_alive_after:
+                try:
+                    status = keep_alive(self.token)
+                except:
+                    status = {}
+                if status.get('status') == 'SUCCESS':
+                    self.token = status.get('token') or self.token
+                    self.refreshed = datetime.utcnow()
+                else:
+                    self.token = None
+            if not self.token:
+                login_data = login()
+                if login_data['loginStatus'] != 'SUCCESS':
+                    return
+                self.token = login_data['sessionToken']
+                self.refreshed = datetime.utcnow()
+            return self.token
+
+    def invalidate(self, token):
+        """Drop the session key after an auth error, unless already renewed."""
+        with self.lock:
+            if self.token == token:
+                self.token = None
+
+
+tokens = TokenManager()
+
+
+def stream_books(races):
+    """Get market books from the Exchange Stream cache."""
+    global stream
+    if stream is None:
+        stream = StreamClient(stream_host, stream_port, xapplication, tokens,
+                              tls=stream_tls, record=stream_record)
+    return stream.market_books(races)
+
+
+def race_ids(markets):
+    """Filter all race events for regular ones."""
+    return [e['marketId'] for e in markets
+            if e['marketName'][0].isdigit()
+            and not e['marketName'].endswith('TBP')]
+
+
+def card_changed(betting, date, known):
+    """Check for races the catalogue lacks, every card_check_every.
+
+    A catalogue call without a projection returns just market ids and
+    names, so it is cheap enough to make between full refreshes.
+    """
+    global card_checked
+    now = datetime.utcnow()
+    if card_checked is not None and now - card_checked < card_check_every:
+        return False
+    card_checked = now
+    markets = betting.list_market_catalogue(
+        day_filter(date, eventTypeIds=['7'], marketCountries=['GB', 'IE']),
+        [], max_results=1000)
+    return bool(set(race_ids(markets)) - set(known['races']))
+
+
+def get_catalogue(betting, date, refresh=False):
+    """Get the day's market catalogue from memory, disk or Betfair."""
+    global catalogue
+    path = os.path.join('data', '{}'.format(date), 'catalogue.json')
+    with catalogue_lock:
+        if not refresh and catalogue.get('date') != date and\
+                os.path.exists(path):
+            with open(path, 'r') as catalogue_file:
+                catalogue = json.load(catalogue_file)
+        if not refresh and catalogue.get('date') == date and\
+                datetime.utcnow() - datetime.strptime(
+                    catalogue['fetched'], '%Y-%m-%dT%H:%M:%S') <\
+                catalogue_every:
+            return catalogue
+
+        # Getting all horse races for the date
+        events = [c['event']['id'] for c in betting.list_events(
+            day_filter(date, eventTypeIds=['7'],
+                       marketCountries=['GB', 'IE']))]
+
+        # Getting all events of each race
+        races_json = {'result': betting.list_market_catalogue(
+            day_filter(date, eventIds=events),
+            ['COMPETITION', 'EVENT', 'EVENT_TYPE', 'MARKET_START_TIME',
+             'RUNNER_DESCRIPTION'])}
+
+        races = race_ids(races_json['result'])
+        catalogue = {'date': date,
+                     'fetched': datetime.utcnow().strftime(
+                         '%Y-%m-%dT%H:%M:%S'),
+                     'catalogue': races_json,
+                     'races': races}
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as catalogue_file:
+            json.dump(catalogue, catalogue_file)
+        return catalogue
+
+
+def fetch_books(betting, races):
+    """Get market books of the given markets."""
+    if streaming:
+        return stream_books(races)
+    return betting.fetch_books(races, projection, parallelism, batch_size)
+
+
+def stale(races, horses):
+    """Check for books of runners the catalogue lacks."""
+    known = set((m['marketId'], r['selectionId']) for m in races['result']
+                for r in m['runners'])
+    return any((m['marketId'], r['selectionId']) not in known
+               for m in horses['result'] for r in m['runners'])
+
+
 def print_table(races, horses, goal, timestamp, date):
     """Print neat table of results."""
-    global data
     table = []
 
-    def f(x):
-        x.loc[-1] = pd.Series([])
-        return x
+    # Indexing the catalogue once instead of scanning it per runner
+    markets = {}
+    runners = {}
+    for event in races['result']:
+        start_time = event['marketStartTime'].split('.')[0].rstrip('Z')
+        markets[event['marketId']] =\
+            [event['event']['name'].upper()[:3],
+             datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%S') +
+             timedelta(hours=0),
+             event['marketName']]
+        for horse in event['runners']:
+            runners[(event['marketId'], horse['selectionId'])] =\
+                horse['runnerName']
     for r in horses['result']:
+        if r['marketId'] not in markets:
+            continue
+        venue, start_time, race = markets[r['marketId']]
         for h in r['runners']:
+            if (r['marketId'], h['selectionId']) not in runners:
+                continue
             entry = []
-            event = (item for item in races['result']
-                     if item['marketId'] == r['marketId']).__next__()
-            entry.append(event['event']['name'].upper()[:3])
-            horse = (item for item in event['runners']
-                     if item['selectionId'] == h['selectionId']).__next__()
-            start_time = event['marketStartTime'].split('T')[-1].split('.')[0]
-            entry.append((datetime.strptime(start_time, '%H:%M:%S') +
-                          timedelta(hours=0)).strftime('%H:%M:%S'))
-            entry.append(horse['runnerName'])
-            entry.append(event['marketName'])
+            entry.append(venue)
+            entry.append(start_time)
+            entry.append(runners[(r['marketId'], h['selectionId'])])
+            entry.append(race)
             try:
                 entry.append(max([float(x['price']) for x
                                   in h['ex']['availableToBack']]))
@@ -199,7 +367,8 @@ def print_table(races, horses, goal, timestamp, date):
                                     reverse=False)[0]['size'])
             except:
                 entry.append('N/A')
-            entry.append(datetime.now().strftime('%Y-%m-%d'))
+            entry.append(datetime.strptime(date, '%Y-%m-%d'))
+            entry.append(h['selectionId'])
             table.append(entry)
     if goal == 'basic':
         data = [{'Venue': e[0],
@@ -211,179 +380,80 @@ def print_table(races, horses, goal, timestamp, date):
                  'Back': e[5],
                  'Lay': e[6]
                  } for e in table if thirty_five(e[4])]
-        [db.basic.update_one(d, {"$set": d}, upsert=True) for d in data]
+        # The first price of the day stays the baseline
+        if data:
+            db.basic.bulk_write([UpdateOne(
+                dict((k, d[k]) for k in basic_key), {"$setOnInsert": d},
+                upsert=True) for d in data], ordered=False)
     elif goal == 'compare':
-        data = list(db.basic.find({'Update': date}))
-        compare = [{'Venue': e[0],
-                    'Time': e[1],
-                    'Horse': e[2],
-                    'Race': e[3],
-                    'Price': e[4],
-                    'Update': e[7],
-                    'Back': e[5],
-                    'Lay': e[6]
-                    } for e in table if thirty_five(e[4])]
-
-        difference = [[e['Venue'], e['Time'],
-                       sign((float(e['Price']) - float(pricerator(e)
-                                                       ))),
-                       e['Horse'],
-                       e['Race'],
-                       e['Back'], e['Lay'], timestamp.replace('-', ':')
-                       ] for e in compare
-                      if floatizer(e['Price']
-                                   ) and pricerator(e)]
-        # maxissimo = [{'Horse': i[3], 'Price': i[2]} for i in difference]
-        # max_to_write = []
-        # max_file = os.path.join('data', '{}'.format(
-        #     date), '{}-max.csv'.format(date))
-        # if os.path.exists(max_file):
-        #     with open(max_file, 'r') as csvfile:
-        #         reader = csv.DictReader(csvfile)
-        #        for h in reader:
-        #            if not [item for item in maxissimo
-        #                    if item["Horse"] == h['Horse']]:
-        #                maxissimo.append(h)
-        #            else:
-        #                maxissimo_item =\
-        #                    [item for item in maxissimo if item["Horse"]
-        #                        == h['Horse']][0]
-        #                if maxissimo_item['Price'] < float(h['Price']):
-        #                    max_to_write.append(maxissimo_item)
-        #                else:
-        #                    max_to_write.append(h)
-        # else:
-        #    max_to_write = maxissimo
-        # with open(max_file, 'w') as csvfile:
-        #    fieldnames = ['Horse', 'Price']
-        #    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        #    writer.writeheader()
-        #    [writer.writerow(i) for i in sorted(max_to_write,
-        #                                        key=lambda k: k['Horse'])]
-        tablissimo = pd.DataFrame(difference, index=None,
-                                  columns=[
-                                      'Venue', 'Time', 'Price', 'Horse',
-                                      'Race', 'Back', 'Lay', 'Update', ])
-        tablissimo = tablissimo.sort_values(
-            ['Time', 'Price'], ascending=[True, True])
-        tablissito = tablissimo[:30].groupby(
-            ['Time'], as_index=False).apply(f).fillna('').to_dict('records')
-        # if not tablissito.empty:
-        #    email_alan(tablissito, date)
-        # tablissimo.groupby(
-        #    ['Time'],
-        #    as_index=False
-        # ).apply(f).fillna('').to_csv(os.path.join('data', '{}'.format(date),
-        #                                          '{}.csv'.format(
-        #    datetime.now().strftime("%H-%M-%S"))), index=False)
-        return tablissito
+        try:
+            history_for(date).append(table)
+        except:
+            logging.warning('Price history is not written!')
+        baseline = baseline_index(db.basic.find(
+            {'Update': datetime.strptime(date, '%Y-%m-%d')},
+            {'_id': 0, 'Horse': 1, 'Time': 1, 'Price': 1}))
+        return compare_table(table, baseline, ranger, timestamp)
 
 
 def get_data(mode):
     """Parse and dump all horses data."""
-    global data
+    for attempt in range(2):
+        token = tokens.get()
+        if not token:
+            return
+        try:
+            return fetch_data(mode, token)
+        except AuthError:
+            tokens.invalidate(token)
+
+
+def fetch_data(mode, token):
+    """Fetch races and prices with the given session key."""
     timestamp = datetime.now().strftime("%H-%M-%S")
     date = datetime.now().strftime("%Y-%m-%d")
-    # Login procedure
-    login_data = login()
-    login_status = login_data['loginStatus']
-    if login_status != 'SUCCESS':
-        return
 
     # Starting main session
-    session = requests.Session()
-    url = "https://api.betfair.com/exchange/betting/json-rpc/v1"
-    header = {'X-Application': xapplication,
-              'X-Authentication': login_data['sessionToken'],
-              'content-type': 'application/json'}
-    # Getting all horse races for the date
-    events_req = """
-    {{
-       "jsonrpc": "2.0",
-       "method": "SportsAPING/v1.0/listEvents",
-       "params": {{"filter":
-                    {{
-                       "eventTypeIds": ["7"],
-                       "marketCountries": ["GB", "IE"],
-                       "marketStartTime": {{
-                                             "from": "{}T00:00:00Z",
-                                             "to": "{}T23:59:00Z"
-                                           }}
-                     }}, "id": 1
-                  }}
-     }}
-    """.format(date, date)
-    events_response = session.post(url, data=events_req, headers=header)
-    events = [c['event']['id'] for c in events_response.json()['result']]
-
-    # Getting all events of each race
-    event_req = """
-    {{
-       "jsonrpc": "2.0",
-       "method": "SportsAPING/v1.0/listMarketCatalogue",
-       "params": {{"filter":
-                    {{
-                       "eventIds": [{}],
-                       "marketStartTime": {{
-                                             "from": "{}T00:00:00Z",
-                                             "to": "{}T23:59:00Z"
-                                           }}
-                     }},
-                  "maxResults": "500",
-                  "marketProjection": [
-                    "COMPETITION",
-                    "EVENT",
-                    "EVENT_TYPE",
-                    "MARKET_START_TIME",
-                    "RUNNER_DESCRIPTION"
-                    ]
-                  }}
-     }}
-    """.format('"' + '","'.join(events) + '"', date, date)
-
-    event_response = session.post(url, data=event_req, headers=header)
-    races_json = event_response.json()
-
-    # Filtering all race events for regular ones
-    races = [e['marketId'] for e in event_response.json()['result']
-             if e['marketName'][0].isdigit()
-             and not e['marketName'].endswith('TBP')]
-    if len(races) > 0:
-        pass
-    else:
+    betting = BetfairClient(xapplication, token)
+    races_json = get_catalogue(betting, date)
+    if card_changed(betting, date, races_json):
+        logging.info('New races on the card, refetching the catalogue')
+        races_json = get_catalogue(betting, date, refresh=True)
+    if not races_json['races']:
         return
-    chunks = [races[x:x + 40] for x in range(0, len(races), 40)]
-    races = []
-    for c in chunks:
-        race_req = """
-        {{
-           "jsonrpc": "2.0",
-           "method": "SportsAPING/v1.0/listMarketBook",
-           "params": {{
-                        "marketIds": [{}],
-                        "priceProjection": {{
-                           "priceData": ["EX_BEST_OFFERS"],
-                           "virtualise": "true"
-                                            }}
-                      }}
-         }}
-        """.format('"' + '","'.join(c) + '"')
-        races.append(session.post(url, data=race_req,
-                                  headers=header).json()['result'])
     race_response = {}
-    race_response['result'] = list(itertools.chain(*races))
+    race_response['result'] = fetch_books(betting, races_json['races'])
+
+    # Unknown runners mean the day's card has changed
+    if stale(races_json['catalogue'], race_response) and\
+            datetime.utcnow() - datetime.strptime(
+                races_json['fetched'], '%Y-%m-%dT%H:%M:%S') >\
+            catalogue_retry:
+        races_json = get_catalogue(betting, date, refresh=True)
     if mode == 'basic':
-        return print_table(races_json, race_response,
+        return print_table(races_json['catalogue'], race_response,
                            'basic', timestamp, date)
     else:
-        return print_table(races_json, race_response,
+        return print_table(races_json['catalogue'], race_response,
                            'compare', timestamp, date)
 
 
 if __name__ == '__main__':
     from config import *
+    from client import AuthError, BetfairClient, day_filter, pool
+    from compare import compare_table
+    from history import history_for
+    from stream import StreamClient
     if parser.parse_args().ranger:
         ranger = float(parser.parse_args().ranger)
+    if parser.parse_args().parallelism:
+        parallelism = int(parser.parse_args().parallelism)
+        pool(parallelism)
+    ensure_basic_indexes()
     get_data('basic')
 else:
     from modules.config import *
+    from modules.client import AuthError, BetfairClient, day_filter, pool
+    from modules.compare import compare_table
+    from modules.history import history_for
+    from modules.stream import StreamClient
@@ -0,0 +1,105 @@
+#!/usr/bin/python3
+"""Time listMarketBook fetching against a local stand-in for the API.
+
+The stub answers JSON-RPC batches after a fixed round-trip latency plus
+a per-market server time, then the same card is fetched serially and
+with the configured concurrency:
+
+    python3 books_bench.py --markets 80 --latency 0.15 --parallelism 4
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from requests.adapters import HTTPAdapter
+
+import client
+from client import BetfairClient, batches, plan
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--markets", type=int, default=80,
+                    help="Market ids on the card.")
+parser.add_argument("--runners", type=int, default=12,
+                    help="Runners in every market.")
+parser.add_argument("--latency", type=float, default=0.15,
+                    help="Seconds of round trip for every request.")
+parser.add_argument("--per-market", type=float, default=0.002,
+                    help="Seconds of server time for every market.")
+parser.add_argument("--parallelism", type=int, default=4,
+                    help="Concurrent requests of the concurrent run.")
+parser.add_argument("--batch-size", type=int, default=3,
+                    help="Chunks per request of the concurrent run.")
+parser.add_argument("--rounds", type=int, default=5,
+                    help="Fetches timed for every setting.")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answer listMarketBook batches with made-up books."""
+
+    def log_message(self, *args):
+        """Keep the benchmark output clean."""
+
+    def do_POST(self):
+        """Wait like the API would, then answer every call."""
+        calls = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])).decode('utf-8'))
+        markets = sum(len(c['params']['marketIds']) for c in calls)
+        time.sleep(self.server.latency + self.server.per_market * markets)
+        answers = [{'jsonrpc': '2.0', 'id': c['id'], 'result': [
+            {'marketId': m, 'runners': [
+                {'selectionId': r,
+                 'ex': {'availableToBack': [{'price': 2.0, 'size': 10.0}],
+                        'availableToLay': [{'price': 2.02, 'size': 8.0}]}}
+                for r in range(self.server.runners)]}
+            for m in c['params']['marketIds']]} for c in calls]
+        body = json.dumps(answers).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def time_fetch(betting, market_ids, projection, parallelism, batch_size,
+               rounds):
+    """Get the mean seconds of one fetch of the card."""
+    started = time.perf_counter()
+    for _ in range(rounds):
+        books = betting.fetch_books(market_ids, projection, parallelism,
+                                    batch_size)
+        assert [b['marketId'] for b in books] == market_ids
+    return (time.perf_counter() - started) / rounds
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = ThreadingHTTPServer(('localhost', 0), StubHandler)
+    server.latency = args.latency
+    server.per_market = args.per_market
+    server.runners = args.runners
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client.url = 'http://localhost:{}/'.format(server.server_port)
+    client.session.mount('http://', HTTPAdapter(
+        pool_maxsize=max(1, args.parallelism)))
+
+    betting = BetfairClient('app-key', 'token')
+    projection = {'priceData': ['EX_BEST_OFFERS'], 'virtualise': True}
+    market_ids = ['1.{}'.format(100000 + i) for i in range(args.markets)]
+    chunks = plan(market_ids, projection)
+    print('{} markets in {} chunks, {:.0f} ms latency, {:.1f} ms/market'
+          .format(args.markets, len(chunks), args.latency * 1000,
+                  args.per_market * 1000))
+    settings = [('serial', 1, 1),
+                ('batched only', 1, args.batch_size),
+                ('concurrent', args.parallelism, args.batch_size)]
+    for name, parallelism, batch_size in settings:
+        seconds = time_fetch(betting, market_ids, projection, parallelism,
+                             batch_size, args.rounds)
+        print('{:<14} parallelism {} batch {} {} requests {:8.1f} ms'
+              .format(name, parallelism, batch_size,
+                      len(batches(chunks, batch_size, parallelism)),
+                      seconds * 1000))
+    server.shutdown()
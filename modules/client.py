@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""Betfair betting API JSON-RPC client."""
+import itertools
+import json
+import math
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+url = 'https://api.betfair.com/exchange/betting/json-rpc/v1'
+auth_errors = ('INVALID_SESSION_INFORMATION', 'NO_SESSION')
+
+# Request weight limit and points per market of each price projection
+max_weight = 200
+weights = {'SP_AVAILABLE': 3,
+           'SP_TRADED': 7,
+           'EX_BEST_OFFERS': 5,
+           'EX_ALL_OFFERS': 17,
+           'EX_TRADED': 17}
+combined = [(frozenset(['EX_ALL_OFFERS', 'EX_TRADED']), 32),
+            (frozenset(['EX_BEST_OFFERS', 'EX_TRADED']), 20)]
+
+# Pooled keep-alive connections shared by every client
+session = requests.Session()
+session.headers.update({'Accept': 'application/json',
+                        'Accept-Encoding': 'gzip, deflate',
+                        'Connection': 'keep-alive',
+                        'content-type': 'application/json'})
+
+
+def pool(size):
+    """Keep up to size connections open to the API."""
+    session.mount('https://', HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=size))
+
+
+pool(4)
+
+
+class APIError(Exception):
+    """Betfair answered a call with an error."""
+
+    def __init__(self, code, message=None):
+        """Remember the Betfair error code."""
+        Exception.__init__(self, message or code)
+        self.code = code
+
+
+class AuthError(APIError):
+    """Betfair rejected the session key."""
+
+
+def day_filter(date, **criteria):
+    """Build a market filter limited to the given day."""
+    criteria['marketStartTime'] = {'from': '{}T00:00:00Z'.format(date),
+                                   'to': '{}T23:59:00Z'.format(date)}
+    return criteria
+
+
+def projection_weight(price_projection):
+    """Get the data weight of one market with the price projection."""
+    data = set(price_projection.get('priceData', []))
+    if not data:
+        return 2
+    weight = 0
+    for pair, pair_weight in combined:
+        if pair <= data:
+            weight += pair_weight
+            data -= pair
+    weight += sum(weights.get(d, 0) for d in data)
+
+    # Deeper best offers cost proportionally more
+    depth = price_projection.get('exBestOffersOverrides', {}).get(
+        'bestPricesDepth', 3)
+    if 'EX_BEST_OFFERS' in price_projection['priceData'] and depth > 3:
+        weight = int(math.ceil(weight * depth / 3.0))
+    return weight
+
+
+def plan(market_ids, price_projection):
+    """Pack market ids into as few requests as the weight limit allows."""
+    size = max(1, max_weight // projection_weight(price_projection))
+    return [market_ids[x:x + size] for x in range(0, len(market_ids), size)]
+
+
+def batches(chunks, batch_size, parallelism):
+    """Group chunks into requests, spreading them over the workers first.
+
+    Chunks share a request only once every worker has one to send, a
+    small card is not worth a single sequential request.
+    """
+    size = int(math.ceil(len(chunks) / float(max(1, parallelism))))
+    size = max(1, min(batch_size, size))
+    return [chunks[x:x + size] for x in range(0, len(chunks), size)]
+
+
+def raise_for_error(answer):
+    """Raise the error of a JSON-RPC answer, if any."""
+    error = answer.get('error')
+    if not error:
+        return
+    try:
+        code = error['data']['APINGException']['errorCode']
+    except (KeyError, TypeError):
+        code = str(error.get('message') or error.get('code'))
+    if code in auth_errors:
+        raise AuthError(code)
+    raise APIError(code, json.dumps(error))
+
+
+class BetfairClient(object):
+    """Typed listEvents/listMarketCatalogue/listMarketBook calls."""
+
+    def __init__(self, app_key, token):
+        """Authenticate every call with the app key and session key."""
+        self.headers = {'X-Application': app_key,
+                        'X-Authentication': token}
+
+    def batch(self, calls):
+        """Send (method, params) calls in one request, return the results."""
+        payload = [{'jsonrpc': '2.0',
+                    'method': 'SportsAPING/v1.0/{}'.format(method),
+                    'params': params,
+                    'id': i} for i, (method, params) in enumerate(calls)]
+        answers = session.post(url, data=json.dumps(
+            payload, separators=(',', ':')), headers=self.headers).json()
+        if isinstance(answers, dict):
+            answers = [answers]
+        by_id = dict((a.get('id'), a) for a in answers)
+        results = []
+        for i in range(len(calls)):
+            answer = by_id.get(i, {'error': {'message': 'NO_ANSWER'}})
+            raise_for_error(answer)
+            results.append(answer['result'])
+        return results
+
+    def call(self, method, params):
+        """Send a single call and return its result."""
+        return self.batch([(method, params)])[0]
+
+    def list_events(self, market_filter):
+        """Get events matching the filter."""
+        return self.call('listEvents', {'filter': market_filter})
+
+    def list_market_catalogue(self, market_filter, projection,
+                              max_results=500):
+        """Get market catalogues matching the filter."""
+        return self.call('listMarketCatalogue',
+                         {'filter': market_filter,
+                          'marketProjection': projection,
+                          'maxResults': max_results})
+
+    def list_market_book(self, market_ids, price_projection):
+        """Get market books of up to one request worth of markets."""
+        return self.call('listMarketBook', {'marketIds': market_ids,
+                                            'priceProjection':
+                                            price_projection})
+
+    def list_market_books(self, chunks, price_projection):
+        """Get market books of several chunks in one batched request."""
+        return self.batch([('listMarketBook',
+                            {'marketIds': c,
+                             'priceProjection': price_projection})
+                           for c in chunks])
+
+    def market_books(self, chunks, price_projection):
+        """Get market books of chunks, splitting the ones that are too big."""
+        try:
+            return list(itertools.chain(*self.list_market_books(
+                chunks, price_projection)))
+        except APIError as e:
+            if e.code != 'TOO_MUCH_DATA':
+                raise
+        books = []
+        for c in chunks:
+            books.extend(self.split_books(c, price_projection))
+        return books
+
+    def fetch_books(self, market_ids, price_projection, parallelism=1,
+                    batch_size=1):
+        """Get market books of any number of markets, concurrently."""
+        groups = batches(plan(market_ids, price_projection), batch_size,
+                         parallelism)
+
+        def fetch_group(g):
+            return self.market_books(g, price_projection)
+
+        # Fetching groups concurrently, map keeps the original order
+        with ThreadPoolExecutor(max_workers=max(1, parallelism)) as executor:
+            books = list(executor.map(fetch_group, groups))
+        return list(itertools.chain(*books))
+
+    def split_books(self, market_ids, price_projection):
+        """Get market books, halving the request on TOO_MUCH_DATA."""
+        try:
+            return self.list_market_book(market_ids, price_projection)
+        except APIError as e:
+            if e.code != 'TOO_MUCH_DATA' or len(market_ids) < 2:
+                raise
+        half = len(market_ids) // 2
+        return self.split_books(market_ids[:half], price_projection) +\
+            self.split_books(market_ids[half:], price_projection)
@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+"""Columnar Betfair price compare engine."""
+import numpy as np
+
+import pandas as pd
+
+book_columns = ['Venue', 'Time', 'Horse', 'Race', 'Price', 'Back', 'Lay',
+                'Update', 'Selection']
+columns = ['Venue', 'Time', 'Price', 'Horse', 'Race', 'Back', 'Lay', 'Update']
+
+
+def baseline_prices(baseline, horses, times):
+    """Look the baseline price up for every runner, NaN if missing."""
+    if not baseline:
+        return np.full(len(horses), np.nan)
+    index = pd.Series(list(baseline.values()),
+                      index=pd.MultiIndex.from_tuples(list(baseline.keys())))
+    return index.reindex(pd.MultiIndex.from_arrays(
+        [horses, times])).to_numpy(dtype=float)
+
+
+def compare_table(table, baseline, ranger, timestamp, limit=30):
+    """Build compare records from market book rows and baseline prices."""
+    book = pd.DataFrame(table, columns=book_columns)
+    price = pd.to_numeric(book['Price'], errors='coerce').to_numpy(
+        dtype=float)
+    base = baseline_prices(baseline, book['Horse'].to_numpy(),
+                           book['Time'].to_numpy())
+
+    # Ranger filter and missing or zero baselines, all at once
+    with np.errstate(invalid='ignore'):
+        keep = (price <= ranger) & ~np.isnan(base) & (base != 0)
+    delta = np.round(price[keep] - base[keep], 2) + 0.0
+    starts = pd.to_datetime(book['Time']).to_numpy()[keep]
+
+    # Sorting by time, then by price difference, and taking the top
+    order = np.lexsort((delta, starts))[:limit]
+    picked = {'Venue': book['Venue'].to_numpy()[keep][order].tolist(),
+              'Time': pd.DatetimeIndex(starts[order]).strftime(
+                  '%H:%M:%S').tolist(),
+              'Price': delta[order].tolist(),
+              'Horse': book['Horse'].to_numpy()[keep][order].tolist(),
+              'Race': book['Race'].to_numpy()[keep][order].tolist(),
+              'Back': book['Back'].to_numpy()[keep][order].tolist(),
+              'Lay': book['Lay'].to_numpy()[keep][order].tolist()}
+    update = timestamp.replace('-', ':')
+
+    # Closing every race with a blank separator row
+    blank = dict((c, '') for c in columns)
+    records = []
+    for i, start_time in enumerate(picked['Time']):
+        if i and start_time != picked['Time'][i - 1]:
+            records.append(blank.copy())
+        records.append({'Venue': picked['Venue'][i],
+                        'Time': start_time,
+                        'Price': picked['Price'][i],
+                        'Horse': picked['Horse'][i],
+                        'Race': picked['Race'][i],
+                        'Back': picked['Back'][i],
+                        'Lay': picked['Lay'][i],
+                        'Update': update})
+    if records:
+        records.append(blank.copy())
+    return records
+
+
+def record_keys(records):
+    """Give every compare record a stable key, separators by their race."""
+    keys = []
+    start_time = ''
+    for record in records:
+        if record['Horse']:
+            start_time = record['Time']
+            keys.append('{}|{}|{}'.format(
+                record['Venue'], record['Time'], record['Horse']))
+        else:
+            keys.append('|{}|'.format(start_time))
+    return keys
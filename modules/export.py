@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+"""Background export of scraped records to CSV, Excel and Parquet."""
+import csv
+import logging
+import os
+import queue
+import threading
+import traceback
+from copy import copy
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.utils import get_column_letter
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+styles = ('font', 'fill', 'border', 'alignment', 'number_format')
+
+
+class Exporter(threading.Thread):
+    """Write records as they come, so the scrape never waits for files.
+
+    The CSV and the checkpoint are appended and flushed as they arrive,
+    the workbook and the Parquet file are streamed and saved on close.
+    """
+
+    def __init__(self, path, name, columns, key, template=None,
+                 parquet=False, batch=500, resume=False):
+        """Export to path/name.csv, path/name_m.xlsx and path/name.parquet.
+
+        key is the columns that identify a record. When resuming, the CSV
+        and the checkpoint are appended to and rows already in the CSV are
+        carried into the workbook and Parquet file, otherwise both start
+        over.
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.path = path
+        self.name = name
+        self.columns = columns
+        self.key = key
+        self.template = template
+        self.parquet = parquet and pyarrow is not None
+        self.batch = batch
+        self.resume = resume
+        self.queue = queue.Queue(maxsize=1000)
+        self.error = None
+        self.closed = False
+        self.seen = set()
+        self.earlier = {}
+        self.pending = []
+
+    def file(self, extension):
+        """Get the path of one of the exported files."""
+        return os.path.join(self.path, self.name + extension)
+
+    def put(self, record):
+        """Queue a record for export."""
+        self.queue.put(('record', record))
+
+    def done(self, link):
+        """Checkpoint an event once its queued records are on disk."""
+        self.queue.put(('done', link))
+
+    def close(self):
+        """Finish the files and wait for the exporter."""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+    def open_sheet(self):
+        """Start a write-only workbook shaped like the template."""
+        self.book = Workbook(write_only=True)
+        self.sheet = self.book.create_sheet('Main')
+        self.styles = [{}] * len(self.columns)
+        header = list(self.columns)
+        if self.template and os.path.exists(self.template):
+            book = load_workbook(self.template)
+            template = book['Main'] if 'Main' in book.sheetnames\
+                else book.active
+            for letter, dimension in template.column_dimensions.items():
+                if dimension.width:
+                    self.sheet.column_dimensions[letter].width =\
+                        dimension.width
+            self.sheet.freeze_panes = template.freeze_panes
+            for i in range(len(self.columns)):
+                title = template.cell(row=1, column=i + 1)
+                cell = WriteOnlyCell(self.sheet, title.value or
+                                     self.columns[i])
+                for style in styles:
+                    setattr(cell, style, copy(getattr(title, style)))
+                header[i] = cell
+                first = template.cell(row=2, column=i + 1)
+                if first.has_style:
+                    self.styles[i] = dict(
+                        (style, copy(getattr(first, style)))
+                        for style in styles)
+        else:
+            for i in range(len(self.columns)):
+                self.sheet.column_dimensions[
+                    get_column_letter(i + 1)].width = 12
+        self.sheet.append(header)
+
+    def sheet_row(self, record):
+        """Turn a record into a workbook row with the template styles."""
+        row = []
+        for column, style in zip(self.columns, self.styles):
+            cell = WriteOnlyCell(self.sheet, record.get(column))
+            for name, value in style.items():
+                setattr(cell, name, value)
+            row.append(cell)
+        return row
+
+    def flush_parquet(self):
+        """Write the buffered records as one Parquet row group."""
+        if not self.parquet or not self.pending:
+            return
+        if self.parquet_writer is None:
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(
+                self.file('.parquet.tmp'), pyarrow.schema(
+                    [(c, pyarrow.string()) for c in self.columns]))
+        self.parquet_writer.write_table(pyarrow.Table.from_pydict(dict(
+            (c, [None if r.get(c) is None else str(r.get(c))
+                 for r in self.pending]) for c in self.columns)))
+        self.pending = []
+
+    def record_key(self, record):
+        """Get the identity of a record, as the CSV would spell it."""
+        return tuple(str(record.get(k)) for k in self.key)
+
+    def add(self, record):
+        """Add a record to the workbook and the Parquet file once."""
+        key = self.record_key(record)
+        if key in self.seen:
+            return
+        self.seen.add(key)
+        self.earlier.pop(key, None)
+        self.sheet.append(self.sheet_row(record))
+        if self.parquet:
+            self.pending.append(record)
+            if len(self.pending) >= self.batch:
+                self.flush_parquet()
+
+    def seed(self):
+        """Read the rows of an earlier run, last copy of a record wins.
+
+        They are written on close, unless this run scrapes them again.
+        """
+        if not os.path.exists(self.file('.csv')):
+            return
+        with open(self.file('.csv'), 'r', newline='') as csvfile:
+            self.earlier = dict((self.record_key(r), r)
+                                for r in csv.DictReader(csvfile))
+
+    def run(self):
+        """Export queued records until close() is called."""
+        try:
+            self.parquet_writer = None
+            self.open_sheet()
+            mode = 'w'
+            if self.resume:
+                self.seed()
+                mode = 'a'
+            with open(self.file('.csv'), mode, newline='') as csvfile,\
+                    open(self.file('.checkpoint'), mode) as checkpoint:
+                writer = csv.DictWriter(csvfile, fieldnames=self.columns,
+                                        extrasaction='ignore')
+                if csvfile.tell() == 0:
+                    writer.writeheader()
+                while True:
+                    item = self.queue.get()
+                    if item is None:
+                        self.closed = True
+                        break
+                    kind, value = item
+                    if kind == 'record':
+                        writer.writerow(value)
+                        self.add(value)
+                        continue
+                    csvfile.flush()
+                    checkpoint.write(value + '\n')
+                    checkpoint.flush()
+            for record in list(self.earlier.values()):
+                self.add(record)
+            self.book.save(self.file('_m.xlsx.tmp'))
+            os.replace(self.file('_m.xlsx.tmp'), self.file('_m.xlsx'))
+            if self.parquet:
+                self.flush_parquet()
+                if self.parquet_writer is not None:
+                    self.parquet_writer.close()
+                    os.replace(self.file('.parquet.tmp'),
+                               self.file('.parquet'))
+        except Exception as e:
+            logging.error('Export failed!')
+            logging.error(traceback.format_exc())
+            self.error = e
+            # Keep draining so the scrape never blocks on a full queue
+            while not self.closed and self.queue.get() is not None:
+                pass
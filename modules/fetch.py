@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+"""Rate-limited concurrent page fetching for the scrapers."""
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+rate = 2.0
+burst = 4
+retries = 5
+backoff = 2.0
+max_backoff = 60.0
+workers = 8
+retry_statuses = (403, 429, 500, 502, 503, 504)
+cache_path = os.path.join('data', 'http-cache')
+cache_size = 512 * 1024 * 1024
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_maxsize=workers))
+pages = ThreadPoolExecutor(max_workers=workers)
+
+buckets = {}
+buckets_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Allow rate requests per second with bursts of up to burst."""
+
+    def __init__(self, rate, burst):
+        """Start with a full bucket."""
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Wait for a token and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class HTTPCache(object):
+    """Disk cache of pages revalidated with conditional requests."""
+
+    def __init__(self, path, max_size):
+        """Remember the cache directory and its size cap in bytes."""
+        self.path = path
+        self.max_size = max_size
+        self.size = None
+        self.lock = threading.Lock()
+
+    def files(self, url):
+        """Get the body and metadata file names of a URL."""
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return (os.path.join(self.path, name + '.body'),
+                os.path.join(self.path, name + '.json'))
+
+    def lookup(self, url):
+        """Get the stored metadata of a URL, None if not cached."""
+        body, meta = self.files(url)
+        try:
+            with open(meta, 'r') as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return
+
+    def validators(self, meta):
+        """Build the conditional request headers from the metadata."""
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def revive(self, url, meta, response):
+        """Turn a 304 response into the stored 200 one.
+
+        Raises OSError if the page was evicted since its lookup.
+        """
+        body, _ = self.files(url)
+        with self.lock:
+            with open(body, 'rb') as body_file:
+                response._content = body_file.read()
+            os.utime(body)
+        response.status_code = 200
+        response.encoding = meta.get('encoding')
+        return response
+
+    def store(self, url, response):
+        """Save a page that can be revalidated later."""
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        body, meta = self.files(url)
+        with self.lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            if self.size is None:
+                self.size = sum(os.path.getsize(os.path.join(self.path, f))
+                                for f in os.listdir(self.path))
+            if os.path.exists(body):
+                self.size -= os.path.getsize(body)
+            with open(body + '.tmp', 'wb') as body_file:
+                body_file.write(response.content)
+            os.replace(body + '.tmp', body)
+            with open(meta + '.tmp', 'w') as meta_file:
+                json.dump({'url': url,
+                           'etag': etag,
+                           'last_modified': last_modified,
+                           'encoding': response.encoding}, meta_file)
+            os.replace(meta + '.tmp', meta)
+            self.size += len(response.content)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Drop the least recently used pages until under the cap."""
+        bodies = [os.path.join(self.path, f) for f in os.listdir(self.path)
+                  if f.endswith('.body')]
+        for body in sorted(bodies, key=os.path.getmtime):
+            if self.size <= self.max_size * 0.9:
+                break
+            self.size -= os.path.getsize(body)
+            os.remove(body)
+            meta = body[:-len('.body')] + '.json'
+            if os.path.exists(meta):
+                os.remove(meta)
+
+    def forget(self, url):
+        """Drop the metadata of a page whose body is gone."""
+        _, meta = self.files(url)
+        with self.lock:
+            if os.path.exists(meta):
+                os.remove(meta)
+
+
+cache = HTTPCache(cache_path, cache_size)
+
+
+def bucket(host):
+    """Get the token bucket of a host."""
+    with buckets_lock:
+        if host not in buckets:
+            buckets[host] = TokenBucket(rate, burst)
+        return buckets[host]
+
+
+def fetch(url, headers=None, blocked=None):
+    """Get a page, retrying blocks with exponential backoff and jitter.
+
+    blocked can flag a successful response as a block page, the last
+    response is returned when all retries are used up. Pages with an
+    ETag or Last-Modified are kept in the cache and revalidated.
+    """
+    host = urlparse(url).netloc
+    response = None
+    meta = cache.lookup(url) if cache else None
+    request_headers = dict(headers or {})
+    if meta:
+        request_headers.update(cache.validators(meta))
+    for attempt in range(retries):
+        bucket(host).take()
+        try:
+            response = session.get(url, headers=request_headers, timeout=30)
+            revived = response.status_code == 304 and meta is not None
+            if revived:
+                try:
+                    response = cache.revive(url, meta, response)
+                except OSError:
+                    # Evicted meanwhile, ask for the full page instead
+                    cache.forget(url)
+                    meta = None
+                    request_headers = dict(headers or {})
+                    bucket(host).take()
+                    response = session.get(url, headers=request_headers,
+                                           timeout=30)
+                    revived = False
+            if response.status_code not in retry_statuses and\
+                    (blocked is None or not blocked(response)):
+                if cache and response.status_code == 200 and not revived:
+                    cache.store(url, response)
+                return response
+        except requests.RequestException:
+            if attempt == retries - 1:
+                raise
+        delay = random.uniform(0, min(max_backoff, backoff * 2 ** attempt))
+        logging.warning('Website blocked request, sleep {:.1f}s...'.format(
+            delay))
+        time.sleep(delay)
+    return response
+
+
+def fetch_async(url, headers=None, blocked=None):
+    """Start fetching a page in the background, return its future."""
+    return pages.submit(fetch, url, headers, blocked)
@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+"""Per-day Betfair price history store."""
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import pandas as pd
+
+dtype = np.dtype([('ts', '<f8'),
+                  ('selection', '<i8'),
+                  ('price', '<f8'),
+                  ('back', '<f8'),
+                  ('lay', '<f8')])
+
+stores = {}
+stores_lock = threading.Lock()
+
+
+def history_for(date):
+    """Get the history store of the given day."""
+    with stores_lock:
+        if date not in stores:
+            stores[date] = PriceHistory(
+                os.path.join('data', '{}'.format(date), 'history'))
+        return stores[date]
+
+
+def seconds(moment):
+    """Turn a datetime or an epoch into epoch seconds."""
+    if isinstance(moment, datetime):
+        return moment.timestamp()
+    return float(moment)
+
+
+class PriceHistory(object):
+    """Append-only array of price snapshots keyed by selection."""
+
+    def __init__(self, path):
+        """Open the store in the given directory."""
+        self.path = path
+        self.prices = os.path.join(path, 'prices.bin')
+        self.runners_file = os.path.join(path, 'runners.json')
+        self.lock = threading.Lock()
+        self.runners = {}
+        if os.path.exists(self.runners_file):
+            with open(self.runners_file, 'r') as runners_file:
+                self.runners = json.load(runners_file)
+
+    def append(self, table, ts=None):
+        """Append one snapshot of print_table rows."""
+        if not table:
+            return
+        book = pd.DataFrame(table)
+        records = np.empty(len(book), dtype=dtype)
+        records['ts'] = time.time() if ts is None else seconds(ts)
+        records['selection'] = book[8].to_numpy(dtype='int64')
+        records['price'] = pd.to_numeric(
+            book[4], errors='coerce').to_numpy(dtype=float)
+        records['back'] = pd.to_numeric(
+            book[5], errors='coerce').to_numpy(dtype=float)
+        records['lay'] = pd.to_numeric(
+            book[6], errors='coerce').to_numpy(dtype=float)
+        with self.lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            with open(self.prices, 'ab') as prices_file:
+                prices_file.write(records.tobytes())
+            fresh = [e for e in table if str(e[8]) not in self.runners]
+            for e in fresh:
+                self.runners[str(e[8])] = {'Venue': e[0],
+                                           'Time': e[1].strftime('%H:%M:%S'),
+                                           'Horse': e[2],
+                                           'Race': e[3]}
+            if fresh:
+                with open(self.runners_file, 'w') as runners_file:
+                    json.dump(self.runners, runners_file)
+
+    def load(self):
+        """Map the stored snapshots into memory, read-only."""
+        if not os.path.exists(self.prices):
+            return np.empty(0, dtype=dtype)
+        count = os.path.getsize(self.prices) // dtype.itemsize
+        if not count:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(self.prices, dtype=dtype, mode='r', shape=(count,))
+
+    def selection(self, runner):
+        """Resolve a horse name or a selection id to a selection id."""
+        if isinstance(runner, str) and not runner.isdigit():
+            with self.lock:
+                runners = list(self.runners.items())
+            for selection, info in runners:
+                if info['Horse'] == runner:
+                    return int(selection)
+            return
+        return int(runner)
+
+    def price_path(self, runner):
+        """Get timestamps, prices, back and lay sizes of a runner."""
+        records = self.load()
+        selection = self.selection(runner)
+        if selection is None:
+            return np.empty(0, dtype=dtype)
+        return np.array(records[records['selection'] == selection])
+
+    def biggest_movers(self, since, limit=10):
+        """Get runners whose price moved most since the given moment."""
+        records = self.load()
+        records = records[(records['ts'] >= seconds(since)) &
+                          ~np.isnan(records['price'])]
+        if not len(records):
+            return []
+        records = records[np.lexsort((records['ts'],
+                                      records['selection']))]
+        selections, first = np.unique(records['selection'],
+                                      return_index=True)
+        last = np.append(first[1:], len(records)) - 1
+        before = records['price'][first]
+        after = records['price'][last]
+        move = after - before
+        movers = []
+        for i in np.argsort(-np.abs(move), kind='stable')[:limit]:
+            info = self.runners.get(str(selections[i]), {})
+            movers.append({'Selection': int(selections[i]),
+                           'Horse': info.get('Horse'),
+                           'Venue': info.get('Venue'),
+                           'Time': info.get('Time'),
+                           'From': float(before[i]),
+                           'To': float(after[i]),
+                           'Move': round(float(move[i]), 2)})
+        return movers
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+"""Background builder for the Betfair compare table."""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+
+class Poller(object):
+    """Rebuild a table on a fixed cadence and keep versioned snapshots."""
+
+    def __init__(self, build, interval, keys=None, volatile=(), keep=30):
+        """Remember the build function and the rebuild interval.
+
+        keys turns the rows into stable row keys for deltas, volatile
+        fields are ignored when deciding whether a row has changed.
+        """
+        self.build = build
+        self.interval = interval
+        self.keys = keys or (lambda rows: [str(i) for i in range(len(rows))])
+        self.volatile = volatile
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.building = False
+        self.thread = None
+        self.rows = None
+        self.built = None
+        # Starting from the clock keeps versions growing across restarts
+        self.version = int(time.time())
+        self.versions = deque(maxlen=keep)
+        self.subscribers = []
+
+    def start(self):
+        """Start the background thread once."""
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Rebuild the snapshot forever."""
+        while True:
+            started = time.monotonic()
+            self.refresh()
+            time.sleep(max(0, self.interval -
+                           (time.monotonic() - started)))
+
+    def strip(self, rows):
+        """Map row keys to rows without their volatile fields."""
+        return dict((k, dict((f, v) for f, v in row.items()
+                             if f not in self.volatile))
+                    for k, row in zip(self.keys(rows), rows))
+
+    def refresh(self):
+        """Rebuild the snapshot, or wait for the rebuild in progress."""
+        with self.lock:
+            if self.building:
+                while self.building:
+                    self.ready.wait()
+                return
+            self.building = True
+        rows = None
+        previous = None
+        try:
+            rows = self.build() or []
+            stripped = self.strip(rows)
+        except:
+            logging.exception('Snapshot rebuild failed!')
+            rows = None
+        with self.lock:
+            self.building = False
+            if rows is not None:
+                self.built = datetime.utcnow()
+                if self.rows is None or\
+                        stripped != self.versions[-1][1] or\
+                        list(stripped) != self.versions[-1][2]:
+                    if self.rows is not None:
+                        previous = self.version
+                    self.version += 1
+                    self.rows = rows
+                    self.versions.append(
+                        (self.version, stripped, list(stripped)))
+            self.ready.notify_all()
+        if previous is not None:
+            self.publish(self.delta(previous))
+
+    def subscribe(self):
+        """Get a queue receiving the delta of every new version."""
+        updates = queue.Queue()
+        with self.lock:
+            self.subscribers.append(updates)
+        return updates
+
+    def unsubscribe(self, updates):
+        """Stop sending deltas to the queue."""
+        with self.lock:
+            if updates in self.subscribers:
+                self.subscribers.remove(updates)
+
+    def publish(self, delta):
+        """Send a delta to every subscriber."""
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for updates in subscribers:
+            updates.put(delta)
+
+    def snapshot(self):
+        """Return the last rows, their build time and version."""
+        self.start()
+        with self.lock:
+            rows, built, version = self.rows, self.built, self.version
+        if rows is None:
+            self.refresh()
+            with self.lock:
+                rows, built, version = self.rows, self.built, self.version
+        if rows is None:
+            return [], None, None
+        return rows, built, version
+
+    def delta(self, since):
+        """Return rows added, changed and removed since a version.
+
+        None means the version is too old or unknown and the caller has
+        to send the whole snapshot.
+        """
+        with self.lock:
+            if not self.versions:
+                return
+            old = dict((v[0], v[1]) for v in self.versions).get(since)
+            version, stripped, order = self.versions[-1]
+            rows = self.rows
+        if old is None:
+            return
+        current = dict(zip(order, rows))
+        return {'version': version,
+                'since': since,
+                'added': dict((k, current[k]) for k in order
+                              if k not in old),
+                'changed': dict((k, current[k]) for k in order
+                                if k in old and old[k] != stripped[k]),
+                'removed': [k for k in old if k not in stripped],
+                'order': order}
@@ -0,0 +1,42 @@
+#!/usr/bin/python3
+"""Time profile state parsing on saved trainer and jockey pages.
+
+    python3 profile_bench.py pages/*.html --number 50
+"""
+import argparse
+import json
+import re
+import timeit
+
+from state import extract_state
+
+parser = argparse.ArgumentParser()
+parser.add_argument("pages", nargs='+', help="Saved profile pages.")
+parser.add_argument("--number", type=int, default=20,
+                    help="Runs of each parser over every page.")
+
+
+def full_parse(text):
+    """Parse the whole state the way the scraper used to."""
+    return json.loads(re.findall(
+        'window.PRELOADED_STATE = ({.*});', text)[0])
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    texts = []
+    for path in args.pages:
+        with open(path, 'r', encoding='utf-8') as page:
+            texts.append(page.read())
+    for text in texts:
+        full = full_parse(text)
+        state = extract_state(text)
+        assert state['recordsByType'] == full.get('recordsByType')
+        assert state['profile']['runningToForm'] ==\
+            full.get('profile', {}).get('runningToForm')
+    for name, parse in [('regex + json.loads', full_parse),
+                        ('extract_state', extract_state)]:
+        seconds = timeit.timeit(lambda: [parse(t) for t in texts],
+                                number=args.number)
+        print('{:<20} {:8.2f} ms/page'.format(
+            name, seconds * 1000 / args.number / len(texts)))
@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+"""Trainer and jockey profile cache with on-disk persistence."""
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+
+class ProfileCache(object):
+    """Memoize parsed profiles by URL, sharing in-flight loads."""
+
+    def __init__(self, path, ttl, load, executor):
+        """Remember the store, its TTL in seconds and the loader.
+
+        load(url) fetches and parses a profile, it runs on the executor.
+        """
+        self.path = path
+        self.ttl = ttl
+        self.load = load
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.memory = {}
+        self.inflight = {}
+        self.db = None
+
+    def connect(self):
+        """Open the on-disk store on first use."""
+        if self.db is None:
+            if not os.path.exists(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS profiles '
+                            '(url TEXT PRIMARY KEY, fetched REAL, '
+                            'state TEXT)')
+        return self.db
+
+    def stored(self, url):
+        """Get a profile from disk if it is fresh enough."""
+        row = self.connect().execute(
+            'SELECT state FROM profiles WHERE url = ? AND fetched > ?',
+            (url, time.time() - self.ttl)).fetchone()
+        if row is not None:
+            return json.loads(row[0])
+
+    def store(self, url, state):
+        """Save a profile to disk."""
+        with self.lock:
+            self.connect().execute(
+                'INSERT OR REPLACE INTO profiles VALUES (?, ?, ?)',
+                (url, time.time(), json.dumps(state)))
+            self.db.commit()
+
+    def get(self, url):
+        """Get a future of the parsed profile of the URL."""
+        with self.lock:
+            if url in self.memory:
+                future = Future()
+                future.set_result(self.memory[url])
+                return future
+            if url in self.inflight:
+                return self.inflight[url]
+            state = self.stored(url)
+            if state is not None:
+                self.memory[url] = state
+                future = Future()
+                future.set_result(state)
+                return future
+            future = self.executor.submit(self.fetch, url)
+            self.inflight[url] = future
+            return future
+
+    def fetch(self, url):
+        """Load a profile, keep it in memory and on disk."""
+        try:
+            state = self.load(url)
+            self.store(url, state)
+            with self.lock:
+                self.memory[url] = state
+            return state
+        finally:
+            with self.lock:
+                self.inflight.pop(url, None)
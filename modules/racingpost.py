@@ -1,21 +1,34 @@
 #!/usr/bin/python3
 """Racing Post horses info scraper."""
-import csv
+import argparse
 import json
 import logging
 import os
+import queue
 import re
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from time import sleep
 
-import requests
-from bson.json_util import dumps
-from lxml import html
-from pymongo import MongoClient
+from lxml import etree, html
+from pymongo import ASCENDING, DESCENDING, MongoClient, UpdateOne
+from pymongo.errors import OperationFailure
 
-import pandas as pd
-from openpyxl import load_workbook
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+if __name__ == '__main__':
+    from export import Exporter
+    from fetch import fetch, fetch_async, pages
+    from profiles import ProfileCache
+    from state import extract_state, marker
+else:
+    from modules.export import Exporter
+    from modules.fetch import fetch, fetch_async, pages
+    from modules.profiles import ProfileCache
+    from modules.state import extract_state, marker
 
 client = MongoClient()
 db = client.betfair
@@ -23,30 +36,77 @@ db = client.betfair
 logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s',
                     level=logging.INFO, datefmt='%Y/%m/%dT%H:%M:%S')
 
+parser = argparse.ArgumentParser()
+parser.add_argument("--fresh", action='store_true',
+                    help="Scrape every event again, even after a crash.")
+
 # Setting access variables
-session = requests.Session()
 headers =\
     {'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 ' +
      '(KHTML, like Gecko) Chrome/63.0.3239.84 Safari/537.36'}
 base = 'https://www.racingpost.com'
-
-# Writing rows in the end to avoid any connection problems, etc.
-rows = []
-
-
-def excelize(dataframe, columns):
-    """Save dataframe as formatted Excel file."""
-    dataframe = dataframe[columns]
+racingpost_key = ['Update', 'Course', 'Time', 'Horse']
+event_workers = 4
+profile_ttl = 24 * 60 * 60
+export_parquet = True
+fieldnames = ['Time', 'Course', 'Age', 'Distance', 'Form', 'Forc', 'Horse',
+              'Go', 'Go %', 'Dist', 'Dist %', 'Cse', 'Cse %',
+              'Trainer', 'T 14dys', 'T D W %', 'T D £1 + -', 'T O/A Seas',
+              'T S W %', 'T S £1 + -', 'RTF %', 'T 5yr O/A', 'T Won', 'Ran',
+              'T W %', 'Plcd', 'T O/A Track', 'T T W %', 'T T £1 + -',
+              'T F Won', 'T F W %', 'T F £1 + -',
+              'Jockey', 'J 14dys', 'J D W %', 'J D £1 + -', 'J O/A Seas',
+              'J S W %', 'J S £1 + -', 'J 5yr O/A', 'J Won', 'Rode', 'J W %',
+              'J O/A Track', 'J T W %', 'J T £1 + -',
+              'J F Won', 'J F W %', 'J F £1 + -', 'Mean']
+
+# Racingpost table paging: columns it can sort by and the page size cap
+sortable = fieldnames + ['Update']
+searchable = ['Horse', 'Trainer', 'Jockey', 'Course']
+sort_indexes = ['Course', 'Time', 'Mean']
+tie_break = ['Course', 'Time']
+max_page = 500
+# Columns kept as text, the others are stored as numbers where they parse
+text_columns = ['Time', 'Course', 'Age', 'Distance', 'Form', 'Forc', 'Horse',
+                'Trainer', 'Jockey', 'T 5yr O/A', 'J 5yr O/A']
+# Digit runs in the text columns still compare as numbers
+collation = {'locale': 'en', 'numericOrdering': True}
+
+
+def ensure_racingpost_indexes():
+    """Create the natural key index for the racecard rows."""
+    keys = [(k, ASCENDING) for k in racingpost_key]
+    try:
+        db.racingpost.create_index(keys, unique=True)
+    except OperationFailure:
+        logging.warning('Duplicate racecard rows, index is not unique!')
+        db.racingpost.create_index(keys)
+    # Sorted pages of a day, they need the same collation as the queries
+    for field in sort_indexes:
+        db.racingpost.create_index(
+            [('Update', ASCENDING), (field, ASCENDING)] +
+            [(f, ASCENDING) for f in tie_break if f != field],
+            collation=collation)
+
+
+def today_path():
+    """Get today's data folder, creating it if needed."""
     path = os.path.join('data', '{}'.format(
         datetime.now().strftime("%Y-%m-%d")))
-    book = load_workbook(os.path.join('assets', 'racingpost_m.xlsx'))
-    writer = pd.ExcelWriter(os.path.join(
-        path, 'racingpost_m.xlsx'), engine='openpyxl')
-    writer.book = book
-    writer.sheets = dict((ws.title, ws) for ws in book.worksheets)
-    dataframe.to_excel(writer, "Main", startrow=1,
-                       startcol=0, index=False, header=False)
-    writer.save()
+    if not os.path.exists(path):
+        os.makedirs(path)
+    return path
+
+
+def number(value):
+    """Turn a cell like '33', '12.5' or '+12.50' into a number."""
+    try:
+        parsed = float(str(value).replace('£', '').replace(',', ''))
+    except ValueError:
+        return value
+    if parsed.is_integer() and '.' not in str(value):
+        return int(parsed)
+    return parsed
 
 
 def totalizer(numbers):
@@ -65,8 +125,8 @@ def totalizer(numbers):
 
 def grab_events():
     """Get a full list of today's events, lad."""
-    code = requests.get(
-        'https://www.racingpost.com/racecards/time-order', headers=headers)
+    code = fetch('https://www.racingpost.com/racecards/time-order',
+                 headers=headers)
 
     # Checking if the page is accessible
     if code.status_code in [502, 503, 404]:
@@ -83,107 +143,149 @@ def grab_events():
     return list(zip(links, years))
 
 
-def process_horse(race_type, advanced, final, tree, num, horse, data):
-    """Fill all the advanced horse data columns."""
-    if tree.xpath(
-        '//span[@data-test-selector="RC-cardPage-runnerNumber-no"]/text()'
-    )[num].strip() == 'NR':
-        logging.warning('\tA horse is not running: {}!'.format(horse.xpath(
-            '//a[@data-test-selector="RC-cardPage-runnerName"]/text()'
-        )[num].strip()))
+def blocked(response):
+    """Check if a profile page lacks its state, so it is a block page."""
+    return marker not in response.text
+
+
+def load_profile(url):
+    """Fetch a trainer or jockey profile and parse the state we use."""
+    return extract_state(fetch(url, headers=headers, blocked=blocked).text)
+
+
+# Profiles are shared by runners and kept on disk between runs
+profiles = ProfileCache(os.path.join('data', 'profiles.sqlite'),
+                        profile_ttl, load_profile, pages)
+
+
+def text_of(path):
+    """Compile a relative XPath returning the first text node, stripped."""
+    return etree.XPath('normalize-space(({})[1])'.format(path))
+
+
+runner_xpaths = {
+    'number': text_of(
+        './/span[@data-test-selector="RC-cardPage-runnerNumber-no"]/text()'),
+    'name': text_of(
+        './/a[@data-test-selector="RC-cardPage-runnerName"]/text()'),
+    'url': text_of(
+        './/a[@data-test-selector="RC-cardPage-runnerName"]/@href'),
+    'age': text_of('.//span[@class="RC-runnerAge"]/text()'),
+    'trainer': text_of(
+        './/a[@data-test-selector="RC-cardPage-runnerTrainer-name"]/text()'),
+    'trainer_url': text_of(
+        './/a[@data-test-selector="RC-cardPage-runnerTrainer-name"]/@href'),
+    'jockey': text_of(
+        './/a[@data-test-selector="RC-cardPage-runnerJockey-name"]/text()'),
+    'jockey_url': text_of(
+        './/a[@data-test-selector="RC-cardPage-runnerJockey-name"]/@href'),
+    'form': etree.XPath(
+        'normalize-space(.//span[@class="RC-runnerInfo__form"])')}
+runner_cards = etree.XPath('//div[@class="RC-runnerCardWrapper"]')
+forecast_links = etree.XPath(
+    '//a[@data-test-selector="RC-bettingForecast_link"]')
+forecast_text = text_of('parent::span//text()')
+table_rows = etree.XPath('//tr[td/a]')
+row_texts = etree.XPath('.//td//text()')
+row_names = etree.XPath('td/a/text()')
+
+
+def parse_racecard(tree):
+    """Turn every runner card of a racecard into a record, in one pass."""
+    forecasts = {}
+    for link in forecast_links(tree):
+        forecasts.setdefault((link.text or '').strip(), forecast_text(link))
+    runners = []
+    for card in runner_cards(tree):
+        runner = dict((field, xpath(card))
+                      for field, xpath in runner_xpaths.items())
+        runner['forecast'] = forecasts.get(runner['name'], 'N/A')
+        runners.append(runner)
+    return runners
+
+
+def normalize(name):
+    """Normalize a horse, trainer or jockey name for lookups."""
+    return ' '.join(re.sub(r'\(.*?\)', ' ', name).lower().split())
+
+
+def index_rows(tree):
+    """Map every name linked in a table row to the row's cleaned cells."""
+    index = {}
+    for row in table_rows(tree):
+        cells = [' '.join(t.split()) for t in row_texts(row) if t.strip()]
+        for name in row_names(row):
+            index.setdefault(normalize(name), cells)
+    return index
+
+
+def lookup(index, name):
+    """Get the cells of a name, falling back to a unique partial match."""
+    key = normalize(name)
+    if key in index:
+        return index[key]
+    matches = [k for k in index if key and key in k]
+    if len(matches) == 1:
+        return index[matches[0]]
+    return []
+
+
+def profile_page(runner, role):
+    """Start getting the trainer or jockey profile of a runner."""
+    if runner[role + '_url']:
+        return profiles.get(base + runner[role + '_url'])
+
+
+def process_horse(race_type, country, advanced, final, runner, data):
+    """Fill all the advanced horse data columns, return the record."""
+    if runner['number'] == 'NR':
+        logging.warning('\tA horse is not running: {}!'.format(
+            runner['name']))
         return
 
-    if data['Course'].endswith('(IRE)') or tree.xpath(
-        '//title/text()')[0].split('|'
-                                   )[0].strip().endswith('(IRE)'):
-        country = 'IRE'
-    else:
-        country = 'GB'
-
-    data['Age'] = horse.xpath(
-        '//span[@class="RC-runnerAge"]/text()')[num].strip()
-    data['Horse'] = horse.xpath(
-        '//a[@data-test-selector="RC-cardPage-runnerName"]/text()'
-    )[num].strip()
+    data['Age'] = runner['age']
+    data['Horse'] = runner['name']
     logging.info('\tProcessing {}'.format(data['Horse']))
-    try:
-        trainer_name = tree.xpath(
-            '//a[contains(text(), "{}")]'.format(data['Horse']) +
-            '/parent::div/parent::div/parent::div' +
-            '//a[@data-test-selector="RC-cardPage-runnerTrainer-name"]' +
-            '/text()')[0].strip()
-        data['Trainer'] = '<a href={}>{}</a>'.format(base + tree.xpath(
-            '//a[contains(text(), "{}")]'.format(data['Horse']) +
-            '/parent::div/parent::div/parent::div' +
-            '//a[@data-test-selector="RC-cardPage-runnerTrainer-name"]' +
-            '/@href')[0].strip(), tree.xpath(
-            '//a[contains(text(), "{}")]'.format(data['Horse']) +
-            '/parent::div/parent::div/parent::div' +
-            '//a[@data-test-selector="RC-cardPage-runnerTrainer-name"]' +
-            '/text()')[0].strip().title())
-    except:
+    trainer_page = profile_page(runner, 'trainer')
+    jockey_page = profile_page(runner, 'jockey')
+    if runner['trainer'] and runner['trainer_url']:
+        trainer_name = runner['trainer']
+        data['Trainer'] = '<a href={}>{}</a>'.format(
+            base + runner['trainer_url'], trainer_name.title())
+    else:
         trainer_name = 'NOBODY'
         data['Trainer'] = 'NOBODY'
-    try:
-        jockey_name = tree.xpath(
-            '//a[contains(text(), "{}")]'.format(data['Horse']) +
-            '/parent::div/parent::div/parent::div' +
-            '//a[@data-test-selector="RC-cardPage-runnerJockey-name"]' +
-            '/text()')[0].strip()
-        data['Jockey'] = '<a href={}>{}</a>'.format(base + tree.xpath(
-            '//a[contains(text(), "{}")]'.format(data['Horse']) +
-            '/parent::div/parent::div/parent::div' +
-            '//a[@data-test-selector="RC-cardPage-runnerJockey-name"]' +
-            '/@href')[0].strip(), tree.xpath(
-            '//a[contains(text(), "{}")]'.format(data['Horse']) +
-            '/parent::div/parent::div/parent::div' +
-            '//a[@data-test-selector="RC-cardPage-runnerJockey-name"]' +
-            '/text()')[0].strip().title())
-    except:
+    if runner['jockey'] and runner['jockey_url']:
+        jockey_name = runner['jockey']
+        data['Jockey'] = '<a href={}>{}</a>'.format(
+            base + runner['jockey_url'], jockey_name.title())
+    else:
         jockey_name = 'NOBODY'
         data['Jockey'] = 'NOBODY'
-    data['Form'] = horse.xpath(
-        'string((//span[@class="RC-runnerInfo__form"])[{}])'.format(num + 1)
-    ).strip()
-    if not data['Form']:
-        data['Form'] = '-'
-
-    # Using regex to get the forecast from text string
-    try:
-        data['Forc'] =\
-            tree.xpath('//a[@data-test-selector="RC-bettingForecast_link" ' +
-                       'and text()="{}"]/parent::span//text()'.format(
-                           data['Horse']))[0].strip()
-    except:
-        data['Forc'] = 'N/A'
+    data['Form'] = runner['form'] or '-'
+    data['Forc'] = runner['forecast']
 
     # Filling the "Horse" advanced columns
-    horse_data = [i.strip() for i in advanced.xpath(
-        '//a[contains(text(), ' +
-        '"{}")][1]/parent::td/parent::tr//td//text()'.format(
-            data['Horse'])) if i.strip()]
-    data['Go'] = re.sub('\s+', ' ', horse_data[1])
-    data['Go %'] = re.sub('\s+', ' ', horse_data[2]).replace('%', '')
-    data['Dist'] = re.sub('\s+', ' ', horse_data[3])
-    data['Dist %'] = re.sub('\s+', ' ', horse_data[4]).replace('%', '')
-    data['Cse'] = re.sub('\s+', ' ', horse_data[5])
-    data['Cse %'] = re.sub('\s+', ' ', horse_data[6]).replace('%', '')
+    horse_data = lookup(advanced, data['Horse'])
+    data['Go'] = horse_data[1]
+    data['Go %'] = horse_data[2].replace('%', '')
+    data['Dist'] = horse_data[3]
+    data['Dist %'] = horse_data[4].replace('%', '')
+    data['Cse'] = horse_data[5]
+    data['Cse %'] = horse_data[6].replace('%', '')
 
     # Filling the "Trainer" advanced columns
-    trainer_data = [i.strip() for i in advanced.xpath(
-        '//a[contains(text(), ' +
-        '"{}")][1]/parent::td/parent::tr//td//text()'.format(
-            trainer_name)) if i.strip()]
+    trainer_data = lookup(advanced, trainer_name)
     try:
-        data['T 14dys'] = re.sub('\s+', ' ', trainer_data[1])
-        data['T D W %'] = re.sub('\s+', ' ', trainer_data[2]).replace('%', '')
-        data['T D £1 + -'] = re.sub('\s+', ' ', trainer_data[3])
-        data['T O/A Seas'] = re.sub('\s+', ' ', trainer_data[4])
-        data['T S W %'] = re.sub('\s+', ' ', trainer_data[5]).replace('%', '')
-        data['T S £1 + -'] = re.sub('\s+', ' ', trainer_data[6])
-        data['T O/A Track'] = re.sub('\s+', ' ', trainer_data[4])
-        data['T T W %'] = re.sub('\s+', ' ', trainer_data[5]).replace('%', '')
-        data['T T £1 + -'] = re.sub('\s+', ' ', trainer_data[6])
+        data['T 14dys'] = trainer_data[1]
+        data['T D W %'] = trainer_data[2].replace('%', '')
+        data['T D £1 + -'] = trainer_data[3]
+        data['T O/A Seas'] = trainer_data[4]
+        data['T S W %'] = trainer_data[5].replace('%', '')
+        data['T S £1 + -'] = trainer_data[6]
+        data['T O/A Track'] = trainer_data[4]
+        data['T T W %'] = trainer_data[5].replace('%', '')
+        data['T T £1 + -'] = trainer_data[6]
     except:
         logging.warning('\t\tMissing trainer data!')
         data['T 14dys'] = '-'
@@ -197,21 +299,7 @@ def process_horse(race_type, advanced, final, tree, num, horse, data):
         data['T T £1 + -'] = '-'
 
     try:
-        for t in range(2):
-            try:
-                advanced_trainer_code = requests.get(base + tree.xpath(
-                    '//a[contains(text(), "{}")]'.format(data['Horse']) +
-                    '/parent::div/parent::div/parent::div' +
-                    '//a[@data-test-selector=' +
-                    '"RC-cardPage-runnerTrainer-name"]/@href')[0],
-                    headers=headers)
-                advanced_trainer_data = json.loads(re.findall(
-                    'window.PRELOADED_STATE = ({.*});',
-                    advanced_trainer_code.text)[0])
-                break
-            except:
-                logging.warning('Website blocked request, sleep...')
-                sleep(30)
+        advanced_trainer_data = trainer_page.result()
 
         data['RTF %'] =\
             str(int(
@@ -300,52 +388,42 @@ def process_horse(race_type, advanced, final, tree, num, horse, data):
             data['T 5yr O/A'] = '{}yo{}'.format(race_type[2][0], race_type[1])
 
     # Filling the trainer "final" columns
-    final_trainer_data = [i.strip() for i in final.xpath(
-        '//a[contains(text(), ' +
-        '"{}")][1]/parent::td/parent::tr//td//text()'.format(
-            trainer_name)) if i.strip()]
+    final_trainer_data = lookup(final, trainer_name)
     try:
         if race_type[0] == 'Jumps':
             if race_type[1] == 'HURDLE':
-                data['T F Won'] = re.sub('\s+', ' ', final_trainer_data[4])
-                data['T F W %'] = re.sub(
-                    '\s+', ' ', final_trainer_data[5]).replace('%', '')
-                data['T F £1 + -'] = re.sub('\s+', ' ', final_trainer_data[6])
+                data['T F Won'] = final_trainer_data[4]
+                data['T F W %'] = final_trainer_data[5].replace('%', '')
+                data['T F £1 + -'] = final_trainer_data[6]
             elif race_type[1] == 'CHASE':
-                data['T F Won'] = re.sub('\s+', ' ', final_trainer_data[7])
-                data['T F W %'] = re.sub(
-                    '\s+', ' ', final_trainer_data[8]).replace('%', '')
-                data['T F £1 + -'] = re.sub('\s+', ' ', final_trainer_data[9])
+                data['T F Won'] = final_trainer_data[7]
+                data['T F W %'] = final_trainer_data[8].replace('%', '')
+                data['T F £1 + -'] = final_trainer_data[9]
             elif race_type[1] == 'NHF':
-                data['T F Won'] = re.sub('\s+', ' ', final_trainer_data[10])
-                data['T F W %'] = re.sub(
-                    '\s+', ' ', final_trainer_data[11]).replace('%', '')
-                data['T F £1 + -'] = re.sub('\s+', ' ', final_trainer_data[12])
+                data['T F Won'] = final_trainer_data[10]
+                data['T F W %'] = final_trainer_data[11].replace('%', '')
+                data['T F £1 + -'] = final_trainer_data[12]
         elif race_type[0] == 'Flat':
-            data['T F Won'] = re.sub('\s+', ' ', final_trainer_data[10])
-            data['T F W %'] = re.sub(
-                '\s+', ' ', final_trainer_data[11]).replace('%', '')
-            data['T F £1 + -'] = re.sub('\s+', ' ', final_trainer_data[12])
+            data['T F Won'] = final_trainer_data[10]
+            data['T F W %'] = final_trainer_data[11].replace('%', '')
+            data['T F £1 + -'] = final_trainer_data[12]
     except:
         data['T F Won'] = '-'
         data['T F W %'] = '-'
         data['T F £1 + -'] = '-'
 
     # Filling the "Jockey" advanced columns
-    jockey_data = [i.strip() for i in advanced.xpath(
-        '//a[contains(text(), ' +
-        '"{}")][1]/parent::td/parent::tr//td//text()'.format(
-            jockey_name)) if i.strip()]
+    jockey_data = lookup(advanced, jockey_name)
     try:
-        data['J 14dys'] = re.sub('\s+', ' ', jockey_data[1])
-        data['J D W %'] = re.sub('\s+', ' ', jockey_data[2]).replace('%', '')
-        data['J D £1 + -'] = re.sub('\s+', ' ', jockey_data[3])
-        data['J O/A Seas'] = re.sub('\s+', ' ', jockey_data[4])
-        data['J S W %'] = re.sub('\s+', ' ', jockey_data[5]).replace('%', '')
-        data['J S £1 + -'] = re.sub('\s+', ' ', jockey_data[6])
-        data['J O/A Track'] = re.sub('\s+', ' ', jockey_data[4])
-        data['J T W %'] = re.sub('\s+', ' ', jockey_data[5]).replace('%', '')
-        data['J T £1 + -'] = re.sub('\s+', ' ', jockey_data[6])
+        data['J 14dys'] = jockey_data[1]
+        data['J D W %'] = jockey_data[2].replace('%', '')
+        data['J D £1 + -'] = jockey_data[3]
+        data['J O/A Seas'] = jockey_data[4]
+        data['J S W %'] = jockey_data[5].replace('%', '')
+        data['J S £1 + -'] = jockey_data[6]
+        data['J O/A Track'] = jockey_data[4]
+        data['J T W %'] = jockey_data[5].replace('%', '')
+        data['J T £1 + -'] = jockey_data[6]
     except:
         logging.warning('\t\tMissing jockey data!')
         data['J 14dys'] = '-'
@@ -359,21 +437,7 @@ def process_horse(race_type, advanced, final, tree, num, horse, data):
         data['J T £1 + -'] = '-'
 
     try:
-        for t in range(2):
-            try:
-                advanced_jockey_code = requests.get(base + tree.xpath(
-                    '//a[contains(text(), "{}")]'.format(data['Horse']) +
-                    '/parent::div/parent::div/parent::div' +
-                    '//a[@data-test-selector=' +
-                    '"RC-cardPage-runnerJockey-name"]/@href')[0],
-                    headers=headers)
-                advanced_jockey_data = json.loads(re.findall(
-                    'window.PRELOADED_STATE = ({.*});',
-                    advanced_jockey_code.text)[0])
-                break
-            except:
-                logging.warning('Website blocked request, sleep...')
-                sleep(30)
+        advanced_jockey_data = jockey_page.result()
 
         if race_type[0] == 'Jumps':
             data['J Won'] =\
@@ -444,32 +508,25 @@ def process_horse(race_type, advanced, final, tree, num, horse, data):
             data['J 5yr O/A'] = '{}yo{}'.format(race_type[2][0], race_type[1])
 
     # Filling the jockey "final" columns
-    final_jockey_data = [i.strip() for i in final.xpath(
-        '//a[contains(text(), ' +
-        '"{}")][1]/parent::td/parent::tr//td//text()'.format(
-            jockey_name)) if i.strip()]
+    final_jockey_data = lookup(final, jockey_name)
     try:
         if race_type[0] == 'Jumps':
             if race_type[1] == 'HURDLE':
-                data['J F Won'] = re.sub('\s+', ' ', final_jockey_data[4])
-                data['J F W %'] = re.sub(
-                    '\s+', ' ', final_jockey_data[5]).replace('%', '')
-                data['J F £1 + -'] = re.sub('\s+', ' ', final_jockey_data[6])
+                data['J F Won'] = final_jockey_data[4]
+                data['J F W %'] = final_jockey_data[5].replace('%', '')
+                data['J F £1 + -'] = final_jockey_data[6]
             elif race_type[1] == 'CHASE':
-                data['J F Won'] = re.sub('\s+', ' ', final_jockey_data[7])
-                data['J F W %'] = re.sub(
-                    '\s+', ' ', final_jockey_data[8]).replace('%', '')
-                data['J F £1 + -'] = re.sub('\s+', ' ', final_jockey_data[9])
+                data['J F Won'] = final_jockey_data[7]
+                data['J F W %'] = final_jockey_data[8].replace('%', '')
+                data['J F £1 + -'] = final_jockey_data[9]
             elif race_type[1] == 'NHF':
-                data['J F Won'] = re.sub('\s+', ' ', final_jockey_data[10])
-                data['J F W %'] = re.sub(
-                    '\s+', ' ', final_jockey_data[11]).replace('%', '')
-                data['J F £1 + -'] = re.sub('\s+', ' ', final_jockey_data[12])
+                data['J F Won'] = final_jockey_data[10]
+                data['J F W %'] = final_jockey_data[11].replace('%', '')
+                data['J F £1 + -'] = final_jockey_data[12]
         elif race_type[0] == 'Flat':
-            data['J F Won'] = re.sub('\s+', ' ', final_jockey_data[10])
-            data['J F W %'] = re.sub(
-                '\s+', ' ', final_jockey_data[11]).replace('%', '')
-            data['J F £1 + -'] = re.sub('\s+', ' ', final_jockey_data[12])
+            data['J F Won'] = final_jockey_data[10]
+            data['J F W %'] = final_jockey_data[11].replace('%', '')
+            data['J F £1 + -'] = final_jockey_data[12]
     except:
         data['J F Won'] = '-'
         data['J F W %'] = '-'
@@ -481,25 +538,22 @@ def process_horse(race_type, advanced, final, tree, num, horse, data):
                               data['T F W %'], data['J D W %'],
                               data['J S W %'],
                               data['J W %'], data['J T W %'], data['J F W %']])
-    data['Horse'] = '<a href={}>{}</a>'.format(base + tree.xpath(
-        '//a[contains(text(), "{}")]'.format(data['Horse']) +
-        '/parent::div/parent::div/parent::div' +
-        '//a[@data-test-selector="RC-cardPage-runnerName"]' +
-        '/@href')[0].strip(), tree.xpath(
-        '//a[contains(text(), "{}")]'.format(data['Horse']) +
-        '/parent::div/parent::div/parent::div' +
-        '//a[@data-test-selector="RC-cardPage-runnerName"]' +
-        '/text()')[0].strip().title())
+    data['Horse'] = '<a href={}>{}</a>'.format(
+        base + runner['url'], runner['name'].title())
     data['Update'] = datetime.now().strftime('%Y-%m-%d')
-    rows.append(data.copy())
+    record = data.copy()
+    for column in fieldnames:
+        if column not in text_columns and column in record:
+            record[column] = number(record[column])
+    return record
 
 
 def process_event(event, year):
-    """Process exact event."""
+    """Process exact event, yield runner records as they are complete."""
     data = {}
 
     # Main code part
-    code = requests.get(event, headers=headers)
+    code = fetch(event, headers=headers)
     tree = html.fromstring(code.text)
     data['Course'] = tree.xpath(
         '//a[@data-test-selector="RC-courseHeader__name"]/text()'
@@ -512,15 +566,13 @@ def process_event(event, year):
             tree.xpath('//title/text()'
                        )[0].split('|')[0].strip().endswith(('(IRE)', '(AW)')):
         return
-    # Advanced code part
-    advanced_code = requests.get(
+    # Advanced and final code parts, fetched side by side
+    advanced_code = fetch_async(
         'https://www.racingpost.com/racecards/data/accordion/{}'.format(
             event.split('/')[-1]), headers=headers)
-    advanced_tree = html.fromstring(advanced_code.text)
-
-    # Final code part
-    final_code = requests.get(event + '/stats', headers=headers)
-    final_tree = html.fromstring(final_code.text)
+    final_code = fetch_async(event + '/stats', headers=headers)
+    advanced_rows = index_rows(html.fromstring(advanced_code.result().text))
+    final_rows = index_rows(html.fromstring(final_code.result().text))
 
     # Checking if the page is accessible
     if code.status_code in [502, 503, 404]:
@@ -575,100 +627,152 @@ def process_event(event, year):
                                                                    ] == 'Flat':
         race_type = ['Jumps', 'NHF']
 
+    if data['Course'].endswith('(IRE)') or tree.xpath(
+        '//title/text()')[0].split('|'
+                                   )[0].strip().endswith('(IRE)'):
+        country = 'IRE'
+    else:
+        country = 'GB'
+
     # Processing advanced columns for each horse
-    for num, horse in enumerate(tree.xpath(
-            '//div[@class="RC-runnerCardWrapper"]')):
-        process_horse(race_type, advanced_tree,
-                      final_tree, tree, num, horse, data)
+    for runner in parse_racecard(tree):
+        record = process_horse(race_type, country, advanced_rows,
+                               final_rows, runner, data)
+        if record is not None:
+            yield record
 
 
-def write_data():
-    """Write data into CSV. Nothing else."""
-    path = os.path.join('data', '{}'.format(
-        datetime.now().strftime("%Y-%m-%d")))
-    if not os.path.exists(path):
-        os.makedirs(path)
-    with open(os.path.join(path, 'racingpost.csv'), 'w', newline=''
-              ) as csvfile:
-        fieldnames = ['Time',
-                      'Course',
-                      'Age',
-                      'Distance',
-                      'Form',
-                      'Forc',
-                      'Horse',
-                      'Go',
-                      'Go %',
-                      'Dist',
-                      'Dist %',
-                      'Cse',
-                      'Cse %',
-                      'Trainer',
-                      'T 14dys',
-                      'T D W %',
-                      'T D £1 + -',
-                      'T O/A Seas',
-                      'T S W %',
-                      'T S £1 + -',
-                      'RTF %',
-                      'T 5yr O/A',
-                      'T Won',
-                      'Ran',
-                      'T W %',
-                      'Plcd',
-                      'T O/A Track',
-                      'T T W %',
-                      'T T £1 + -',
-                      'T F Won',
-                      'T F W %',
-                      'T F £1 + -',
-                      'Jockey',
-                      'J 14dys',
-                      'J D W %',
-                      'J D £1 + -',
-                      'J O/A Seas',
-                      'J S W %',
-                      'J S £1 + -',
-                      'J 5yr O/A',
-                      'J Won',
-                      'Rode',
-                      'J W %',
-                      'J O/A Track',
-                      'J T W %',
-                      'J T £1 + -',
-                      'J F Won',
-                      'J F W %',
-                      'J F £1 + -',
-                      'Mean']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        writer.writeheader()
-        writer.writerows(rows)
-        sleep(3)
-        excelize(pd.DataFrame(rows), fieldnames)
-
-
-def racingpost():
-    """Use this function to wrap everything up."""
-    # Grab all today's links!
-    events = grab_events()
-    for event in events:
-        logging.info(event[0])
-        [process_event(
-            base + event[0].replace('results', 'racecards'), event[1])]
-    [db.racingpost.update_one(r, {'$set': r}, upsert=True) for r in rows]
+def event_records(events):
+    """Scrape events concurrently, yield records as soon as they are done.
 
+    Yields ('record', link, record) for every runner and ('done', link, ok)
+    once an event is finished, ok is False if it failed halfway.
+    """
+    results = queue.Queue()
 
-def get_racingpost():
-    """Use this function to get racingpost table."""
-    return dumps(list(d for d in db.racingpost.find(
-        {'Update': {'$gte': datetime.now().strftime('%Y-%m-%d')},
-         'Trainer': {'$ne': 'NOBODY'},
-         'Jockey': {'$ne': 'NOBODY'}})))
+    def scrape(event):
+        logging.info(event[0])
+        ok = False
+        try:
+            for record in process_event(
+                    base + event[0].replace('results', 'racecards'),
+                    event[1]):
+                results.put(('record', event[0], record))
+            ok = True
+        except:
+            logging.error('Event failed: {}'.format(event[0]))
+            logging.error(traceback.format_exc())
+        finally:
+            results.put(('done', event[0], ok))
+
+    with ThreadPoolExecutor(max_workers=event_workers) as executor:
+        for event in events:
+            executor.submit(scrape, event)
+        for _ in range(len(events)):
+            while True:
+                item = results.get()
+                yield item
+                if item[0] == 'done':
+                    break
+
+
+def load_checkpoint(path):
+    """Get the links of the events finished by an earlier run."""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'r') as checkpoint:
+        return set(line.strip() for line in checkpoint if line.strip())
+
+
+def save_records(records):
+    """Upsert the records of one event."""
+    if records:
+        db.racingpost.bulk_write([UpdateOne(
+            dict((k, r[k]) for k in racingpost_key), {'$set': r},
+            upsert=True) for r in records], ordered=False)
+
+
+def racingpost(fresh=False):
+    """Use this function to wrap everything up.
+
+    Runners go to the exporter as they come and to Mongo once their event
+    is done. Finished events are checkpointed, so a rerun after a crash or
+    a failed event skips them. The checkpoint is dropped once every event
+    is done, the next run of the day then scrapes the whole card again.
+    """
+    path = today_path()
+    checkpoint_path = os.path.join(path, 'racingpost.checkpoint')
+    resume = not fresh and os.path.exists(checkpoint_path)
+    exporter = Exporter(path, 'racingpost', fieldnames,
+                        ['Course', 'Time', 'Horse'],
+                        template=os.path.join('assets', 'racingpost_m.xlsx'),
+                        parquet=export_parquet, resume=resume)
+
+    # Grab all today's links, except the ones already done
+    finished = load_checkpoint(checkpoint_path) if resume else set()
+    events = [e for e in grab_events() or [] if e[0] not in finished]
+    if finished:
+        logging.info('Resuming, {} events already done'.format(
+            len(finished)))
+
+    exporter.start()
+    pending = {}
+    failed = 0
+    try:
+        for kind, link, value in event_records(events):
+            if kind == 'record':
+                exporter.put(value)
+                pending.setdefault(link, []).append(value)
+                continue
+            save_records(pending.pop(link, []))
+            if value:
+                exporter.done(link)
+            else:
+                failed += 1
+    finally:
+        exporter.close()
+    if failed:
+        logging.warning('{} events failed, rerun to resume them'.format(
+            failed))
+    else:
+        os.remove(checkpoint_path)
+
+
+def get_racingpost(limit=50, offset=0, sort=None, order='asc',
+                   search=None):
+    """Use this function to get one page of the racingpost table.
+
+    Returns bootstrap-table's server side JSON, {"total": n, "rows": [...]}.
+    """
+    query = {'Update': datetime.now().strftime('%Y-%m-%d'),
+             'Trainer': {'$ne': 'NOBODY'},
+             'Jockey': {'$ne': 'NOBODY'}}
+    if search:
+        pattern = {'$regex': re.escape(search), '$options': 'i'}
+        query['$or'] = [{field: pattern} for field in searchable]
+    # Ties go the same way as the sort so an index can be walked backwards
+    if sort not in sortable:
+        sort = tie_break[0]
+    direction = DESCENDING if order == 'desc' else ASCENDING
+    sorting = [(sort, direction)] + [(f, direction) for f in tie_break
+                                     if f != sort]
+    limit = min(max(limit or 50, 1), max_page)
+    cursor = db.racingpost.find(
+        query, dict([(f, 1) for f in sortable] + [('_id', 0)]),
+        sort=sorting, skip=max(offset or 0, 0), limit=limit,
+        collation=collation)
+    page = {'total': db.racingpost.count_documents(query,
+                                                   collation=collation),
+            'rows': list(cursor)}
+    if orjson is not None:
+        return orjson.dumps(page)
+    return json.dumps(page, separators=(',', ':'))
 
 
 if __name__ == '__main__':
     try:
-        racingpost()
+        ensure_racingpost_indexes()
+        racingpost(fresh=parser.parse_args().fresh)
         # excelize()
     except:
         logging.critical(traceback.print_exc())
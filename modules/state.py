@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+"""Pull the parts we use out of a profile page's PRELOADED_STATE."""
+import json
+import re
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+marker = 'window.PRELOADED_STATE ='
+decoder = json.JSONDecoder()
+whitespace = re.compile(r'[ \t\n\r]*')
+
+# Top-level members of the state the scraper reads
+wanted = ('profile', 'recordsByType')
+
+
+def bounds(text):
+    """Find where the state object starts and ends, -1 if it is missing."""
+    start = text.find(marker)
+    if start < 0:
+        return -1, -1
+    start = text.find('{', start + len(marker))
+    end = text.find('</script>', start)
+    if start < 0 or end < 0:
+        return -1, -1
+    end = text.rfind('}', start, end) + 1
+    return start, end
+
+
+def members(text, start):
+    """Decode the wanted top-level members of the object at start.
+
+    Members are walked in order and the walk stops once every wanted one
+    is found, so whatever follows them is never decoded.
+    """
+    found = {}
+    at = whitespace.match(text, start + 1).end()
+    while text[at] != '}' and len(found) < len(wanted):
+        key, at = decoder.raw_decode(text, at)
+        at = whitespace.match(text, at).end()
+        if text[at] != ':':
+            raise ValueError('Expected a colon at {}'.format(at))
+        at = whitespace.match(text, at + 1).end()
+        value, at = decoder.raw_decode(text, at)
+        if key in wanted:
+            found[key] = value
+        at = whitespace.match(text, at).end()
+        if text[at] == ',':
+            at = whitespace.match(text, at + 1).end()
+    return found
+
+
+def loads(blob):
+    """Parse a JSON string, with orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(blob)
+    return json.loads(blob)
+
+
+def extract_state(text):
+    """Get runningToForm and recordsByType of a profile page.
+
+    They keep their nesting in the full state, profile holds nothing but
+    runningToForm. A state the member walk chokes on is parsed in full.
+    """
+    start, end = bounds(text)
+    if start < 0:
+        raise ValueError('No PRELOADED_STATE in the page')
+    try:
+        state = members(text, start)
+    except (ValueError, IndexError):
+        state = loads(text[start:end])
+    return {'profile': {'runningToForm': (state.get('profile') or {}).get(
+        'runningToForm')},
+        'recordsByType': state.get('recordsByType') or {}}
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+"""Betfair Exchange Stream API client with an order book cache."""
+import json
+import logging
+import socket
+import ssl
+import threading
+import time
+
+auth_errors = ('INVALID_SESSION_INFORMATION', 'NO_SESSION')
+
+# Virtual (display) ladders win over the raw ones, like virtualise=true
+ladders = [('availableToBack', ('bdatb', 'batb')),
+           ('availableToLay', ('bdatl', 'batl'))]
+
+
+class StreamError(Exception):
+    """The stream server refused a request."""
+
+
+class MarketCache(object):
+    """Order books of the subscribed markets, built from change messages."""
+
+    def __init__(self):
+        """Start with no markets."""
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.markets = {}
+
+    def apply(self, message):
+        """Apply one mcm message to the cache."""
+        with self.lock:
+            for mc in message.get('mc', []):
+                if mc.get('img') or mc['id'] not in self.markets:
+                    self.markets[mc['id']] = {'definition': {},
+                                              'runners': {}}
+                market = self.markets[mc['id']]
+                if 'marketDefinition' in mc:
+                    market['definition'] = mc['marketDefinition']
+                for rc in mc.get('rc', []):
+                    runner = market['runners'].setdefault(rc['id'], {})
+                    if rc.get('img'):
+                        runner.clear()
+                    for field, levels in rc.items():
+                        if not isinstance(levels, list):
+                            continue
+                        ladder = runner.setdefault(field, {})
+                        for level, price, size in levels:
+                            if size:
+                                ladder[level] = (price, size)
+                            else:
+                                ladder.pop(level, None)
+            self.changed.notify_all()
+
+    def wait(self, market_ids, timeout):
+        """Wait until every market has an image, or the timeout passes."""
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while not all(m in self.markets for m in market_ids):
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                self.changed.wait(left)
+            return True
+
+    def market_books(self, market_ids):
+        """Build listMarketBook-like results for the given markets."""
+        books = []
+        with self.lock:
+            for market_id in market_ids:
+                market = self.markets.get(market_id)
+                if market is None:
+                    continue
+                selections = [r['id'] for r in market['definition'].get(
+                    'runners', []) if r.get('status', 'ACTIVE') == 'ACTIVE']
+                if not market['definition']:
+                    selections = list(market['runners'])
+                runners = []
+                for selection in selections:
+                    runner = market['runners'].get(selection, {})
+                    ex = {}
+                    for side, fields in ladders:
+                        ladder = {}
+                        for field in fields:
+                            if field in runner:
+                                ladder = runner[field]
+                                break
+                        ex[side] = [{'price': ladder[level][0],
+                                     'size': ladder[level][1]}
+                                    for level in sorted(ladder)]
+                    runners.append({'selectionId': selection, 'ex': ex})
+                books.append({'marketId': market_id, 'runners': runners})
+        return books
+
+
+class StreamClient(object):
+    """Keep a market subscription alive and feed the cache."""
+
+    def __init__(self, host, port, app_key, tokens, tls=True, record=None,
+                 heartbeat=5000):
+        """Remember where to connect and how to authenticate."""
+        self.host = host
+        self.port = port
+        self.app_key = app_key
+        self.tokens = tokens
+        self.tls = tls
+        self.record = record
+        self.heartbeat = heartbeat
+        self.cache = MarketCache()
+        self.market_ids = []
+        self.clk = None
+        self.initial_clk = None
+        self.sock = None
+        self.send_lock = threading.Lock()
+        self.thread = None
+        self.ids = 0
+
+    def subscribe(self, market_ids):
+        """Subscribe to the markets, replacing the previous subscription.
+
+        Returns the ids that were not subscribed to before.
+        """
+        market_ids = sorted(market_ids)
+        if market_ids == self.market_ids:
+            return []
+        added = sorted(set(market_ids) - set(self.market_ids))
+        self.market_ids = market_ids
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        elif self.sock is not None:
+            self.clk = self.initial_clk = None
+            try:
+                self.send_subscription()
+            except OSError:
+                logging.warning('Stream resubscription failed!')
+        return added
+
+    def market_books(self, market_ids, timeout=10):
+        """Get the cached order books, waiting for new markets' images.
+
+        Markets that never get an image, like closed races, are waited for
+        only once, after that the books the cache holds are returned.
+        """
+        added = self.subscribe(market_ids)
+        if added:
+            self.cache.wait(added, timeout)
+        return self.cache.market_books(market_ids)
+
+    def send(self, message):
+        """Send one CRLF-terminated JSON message."""
+        with self.send_lock:
+            self.ids += 1
+            message['id'] = self.ids
+            self.sock.sendall((json.dumps(message) + '\r\n').encode('utf-8'))
+            return message['id']
+
+    def send_subscription(self):
+        """Subscribe to the current markets, resuming from the last clock."""
+        message = {'op': 'marketSubscription',
+                   'heartbeatMs': self.heartbeat,
+                   'marketFilter': {'marketIds': self.market_ids},
+                   'marketDataFilter': {'fields': ['EX_BEST_OFFERS_DISP',
+                                                   'EX_MARKET_DEF'],
+                                        'ladderLevels': 3}}
+        if self.clk:
+            message['clk'] = self.clk
+            message['initialClk'] = self.initial_clk
+        return self.send(message)
+
+    def connect(self):
+        """Open the socket, authenticate and subscribe."""
+        sock = socket.create_connection((self.host, self.port), timeout=10)
+        if self.tls:
+            sock = ssl.create_default_context().wrap_socket(
+                sock, server_hostname=self.host)
+        # Three missed heartbeats mean the connection is dead
+        sock.settimeout(self.heartbeat * 3 / 1000.0)
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        token = self.tokens.get()
+        self.send({'op': 'authentication',
+                   'appKey': self.app_key,
+                   'session': token})
+        self.token = token
+        self.send_subscription()
+
+    def handle(self, message):
+        """Dispatch one message from the server."""
+        if message.get('op') == 'status':
+            if message.get('statusCode') == 'FAILURE':
+                if message.get('errorCode') in auth_errors:
+                    self.tokens.invalidate(self.token)
+                raise StreamError('{}: {}'.format(
+                    message.get('errorCode'), message.get('errorMessage')))
+        elif message.get('op') == 'mcm':
+            if message.get('initialClk'):
+                self.initial_clk = message['initialClk']
+            if message.get('clk'):
+                self.clk = message['clk']
+            self.cache.apply(message)
+
+    def run(self):
+        """Read the stream forever, reconnecting with a backoff."""
+        backoff = 1
+        while True:
+            try:
+                self.connect()
+                for line in self.reader:
+                    if self.record is not None:
+                        with open(self.record, 'ab') as record_file:
+                            record_file.write(line)
+                    self.handle(json.loads(line.decode('utf-8')))
+                    backoff = 1
+                logging.warning('Stream closed by the server!')
+            except (OSError, ValueError, StreamError) as e:
+                logging.warning('Stream connection lost: {}'.format(e))
+            finally:
+                if self.sock is not None:
+                    self.sock.close()
+                    self.sock = None
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 60)
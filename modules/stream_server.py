@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+"""Local stand-in for the Betfair Exchange Stream API.
+
+Replays change messages recorded by StreamClient(record=...) to any
+client that authenticates and subscribes, plain TCP, no TLS:
+
+    python3 stream_server.py data/2018-01-05/stream.jsonl --port 7777
+"""
+import argparse
+import json
+import logging
+import socketserver
+import threading
+import time
+
+logging.basicConfig(format='[%(asctime)s] %(levelname)s: %(message)s',
+                    level=logging.INFO, datefmt='%Y/%m/%dT%H:%M:%S')
+
+parser = argparse.ArgumentParser()
+parser.add_argument("recording",
+                    help="File with recorded stream messages, one per line.")
+parser.add_argument("--host", default='localhost',
+                    help="Address to listen on.")
+parser.add_argument("--port", type=int, default=7777,
+                    help="Port to listen on.")
+parser.add_argument("--delay", type=float, default=0.5,
+                    help="Seconds between replayed change messages.")
+
+
+def load_recording(path):
+    """Read the market change messages of a recording."""
+    messages = []
+    with open(path, 'r') as recording:
+        for line in recording:
+            if line.strip():
+                message = json.loads(line)
+                if message.get('op') == 'mcm':
+                    messages.append(message)
+    return messages
+
+
+class StreamHandler(socketserver.StreamRequestHandler):
+    """Speak just enough of the stream protocol to replay a recording."""
+
+    def send(self, message):
+        """Send one CRLF-terminated JSON message."""
+        with self.lock:
+            self.wfile.write((json.dumps(message) + '\r\n').encode('utf-8'))
+            self.wfile.flush()
+
+    def replay(self, sub_id, market_ids, heartbeat, stop):
+        """Send the recorded changes of the subscribed markets."""
+        try:
+            for message in self.server.messages:
+                if stop.is_set():
+                    return
+                message = dict(message, id=sub_id)
+                if market_ids:
+                    message['mc'] = [mc for mc in message.get('mc', [])
+                                     if mc['id'] in market_ids]
+                self.send(message)
+                time.sleep(self.server.delay)
+            while not stop.wait(heartbeat / 1000.0):
+                self.send({'op': 'mcm', 'id': sub_id, 'ct': 'HEARTBEAT',
+                           'clk': 'replay', 'pt': int(time.time() * 1000)})
+        except OSError:
+            stop.set()
+
+    def handle(self):
+        """Answer authentication and subscription requests."""
+        self.lock = threading.Lock()
+        stop = threading.Event()
+        self.send({'op': 'connection', 'connectionId': 'replay'})
+        try:
+            for line in self.rfile:
+                request = json.loads(line.decode('utf-8'))
+                self.send({'op': 'status', 'id': request.get('id'),
+                           'statusCode': 'SUCCESS',
+                           'connectionClosed': False})
+                if request.get('op') == 'marketSubscription':
+                    stop.set()
+                    stop = threading.Event()
+                    threading.Thread(target=self.replay, daemon=True, args=(
+                        request['id'],
+                        request.get('marketFilter', {}).get('marketIds'),
+                        request.get('heartbeatMs', 5000), stop)).start()
+        except (OSError, ValueError):
+            pass
+        finally:
+            stop.set()
+
+
+class StreamServer(socketserver.ThreadingTCPServer):
+    """Threaded replay server."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, messages, delay):
+        """Keep the recording for every connection."""
+        self.messages = messages
+        self.delay = delay
+        socketserver.ThreadingTCPServer.__init__(self, address, StreamHandler)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    server = StreamServer((args.host, args.port),
+                          load_recording(args.recording), args.delay)
+    logging.info('Replaying {} on {}:{}'.format(
+        args.recording, args.host, args.port))
+    server.serve_forever()